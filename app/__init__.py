@@ -31,7 +31,6 @@ for most user model classes.
 '''
 
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 
 from flask_mail import Mail
@@ -44,11 +43,14 @@ from elasticsearch import Elasticsearch
 import rq
 from redis import Redis
 
+from app.sharding import ShardedSession
+
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
     # return 'de'
 
-db = SQLAlchemy()
+# The session routes the sharded models (posts, messages) to their databases; see app/sharding.py.
+db = SQLAlchemy(session_options={'class_': ShardedSession})
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -85,7 +87,21 @@ def create_app(config_class=Config):
         if app.config['ELASTICSEARCH_URL'] else None
     
     app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    app.task_queues = {name: rq.Queue(f'microblog-{name}', connection=app.redis)
+                       for name in app.config['TASK_QUEUES']}
+    app.task_queue = app.task_queues[app.config['TASK_DEFAULT_QUEUE']]
+
+    if app.config['TRUSTED_PROXIES']:
+        # The client's address, as the proxies saw it; the per-IP rate limits depend on it.
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        n = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=n, x_proto=n, x_host=n)
+
+    from app.ratelimit import init_app as init_ratelimit
+    init_ratelimit(app)
+
+    from app.relationships import init_app as init_relationships
+    init_relationships(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -103,35 +119,15 @@ def create_app(config_class=Config):
     from app.cli import bp as cli_bp
     app.register_blueprint(cli_bp)
 
+    from app.assets import bp as assets_bp, init_app as init_assets
+    init_assets(app)
+    app.register_blueprint(assets_bp)
+
 
     if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'],
-                        app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/microblog.log',
-                                           maxBytes=10240, backupCount=10)
-        # Once the log reaches its size limit of 10 KB, it will rename the current log file and create a new log file
-        # Keeps only the last 10 log files (backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+        # Request threads only queue their records; see app/logqueue.py.
+        from app.logqueue import init_app as init_logging
+        init_logging(app)
 
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
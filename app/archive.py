@@ -0,0 +1,78 @@
+# Hot/cold split of the post table.
+#
+# Posts older than POST_ARCHIVE_AGE are moved, in chunks, from post to post_archive by the
+# archive_posts task. The post table, its timestamp index and the joins of following_posts()
+# then only cover recent history. Listings are written as a function that builds the query for a
+# given model (Post or ArchivedPost); paginate() serves pages from the post table and only
+# continues into the archive once a page goes past its end, so the archive is never touched by
+# the first pages, which is where nearly all reads happen.
+#
+# Both tables are sharded like the posts themselves (app/sharding.py); a listing is read from
+# the shards it names, and archive_posts() works through the shards one after the other.
+
+import sqlalchemy as sa
+from app import db, sharding
+from app.models import Post, ArchivedPost
+
+
+class Page:
+    '''The parts of a Flask-SQLAlchemy Pagination that the templates and views use.'''
+
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+        self.has_prev = page > 1
+        self.next_num = page + 1 if has_next else None
+        self.prev_num = page - 1 if page > 1 else None
+
+
+def paginate(query_for, page, per_page, shards=None):
+    '''
+    One page of a post listing; query_for(model) returns the listing's select for model, newest
+    first, and shards are the shards that hold its posts (all of them by default).
+    '''
+    shards = shards or sharding.shards()
+    page = max(page, 1)
+    offset = (page - 1) * per_page
+    items = sharding.select_page(query_for(Post), Post, shards, offset, per_page + 1)
+    if len(items) > per_page:
+        return Page(items[:per_page], page, True)
+    if len(items) == per_page:
+        # The last full page of the hot table: there is more if the archive has anything for
+        # this listing.
+        has_next = bool(sharding.select_page(query_for(ArchivedPost), ArchivedPost, shards, 0, 1))
+        return Page(items, page, has_next)
+
+    # Past the end of the hot table: continue in the archive where the hot rows ran out. Only
+    # a page entirely past that end needs to count them.
+    hot_total = offset + len(items) if items or page == 1 else \
+        sharding.count(query_for(Post), shards)
+    wanted = per_page - len(items)
+    archived = sharding.select_page(query_for(ArchivedPost), ArchivedPost, shards,
+                                    max(0, offset - hot_total), wanted + 1)
+    return Page(items + archived[:wanted], page, len(archived) > wanted)
+
+
+def archive_posts(cutoff, chunk_size):
+    '''
+    Move posts older than cutoff to the archive, chunk_size posts per transaction. Returns the
+    number of posts moved.
+    '''
+    columns = [Post.id, Post.body, Post.timestamp, Post.user_id, Post.language]
+    moved = 0
+    for shard in sharding.shards():
+        # The newest post always stays, so SQLite cannot hand an archived id out again.
+        newest = sharding.execute(shard, sa.select(sa.func.max(Post.id))).scalar()
+        while True:
+            ids = sharding.scalars(shard,
+                sa.select(Post.id).where(Post.timestamp < cutoff, Post.id != newest)
+                .order_by(Post.id).limit(chunk_size)).all()
+            if not ids:
+                break
+            sharding.execute(shard, ArchivedPost.__table__.insert().from_select(
+                [column.key for column in columns], sa.select(*columns).where(Post.id.in_(ids))))
+            sharding.execute(shard, sa.delete(Post).where(Post.id.in_(ids)))
+            db.session.commit()
+            moved += len(ids)
+    return moved
@@ -0,0 +1,156 @@
+# Static asset pipeline.
+# The vendored libraries under static/vendor and our own scripts under static/js are concatenated
+# into bundles whose file names carry a hash of their content (app.<hash>.js). Because a new
+# build always gets a new name, the bundles can be cached by browsers "forever".
+
+import gzip
+import os
+import re
+import threading
+import time
+from hashlib import sha256
+import click
+from flask import Blueprint, current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+bp = Blueprint('assets', __name__, cli_group=None)
+
+BUNDLES = {
+    'app.css': ['vendor/bootstrap.min.css'],
+    'app.js': ['vendor/popper.min.js', 'vendor/bootstrap.min.js',
+               'vendor/moment-with-locales.min.js', 'js/app.js'],
+}
+
+ONE_YEAR = 365 * 24 * 3600
+SOURCE_MAP = re.compile(rb'^[/*#@ ]*sourceMappingURL=.*$', re.MULTILINE)
+# app.0123456789ab.js, app.0123456789ab.js.gz, app.0123456789ab.js.1234-5678.tmp, ...
+BUNDLE_FILE = re.compile(r'^([\w-]+\.[0-9a-f]{12}\.(?:js|css))(?:\.gz|\.br|\.\d+(?:-\d+)?\.tmp)*$')
+
+
+def _dist_folder(app):
+    return os.path.join(app.static_folder, 'dist')
+
+
+def build_bundles(app):
+    '''
+    Write every bundle (plus .gz and .br variants) to static/dist and return a manifest that
+    maps bundle names to their fingerprinted file names. Bundles that already exist are not rewritten,
+    and those of earlier builds are pruned (see _prune).
+    '''
+    os.makedirs(_dist_folder(app), exist_ok=True)
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            with open(os.path.join(app.static_folder, source), 'rb') as f:
+                # The source maps are not vendored, so drop the references to them.
+                parts.append(SOURCE_MAP.sub(b'', f.read()))
+        separator = b';\n' if name.endswith('.js') else b'\n'
+        content = separator.join(parts)
+
+        base, ext = os.path.splitext(name)
+        filename = f'{base}.{sha256(content).hexdigest()[:12]}{ext}'
+        path = os.path.join(_dist_folder(app), filename)
+        if not os.path.exists(path):
+            _write(path + '.gz', gzip.compress(content, compresslevel=9))
+            if brotli is not None:
+                _write(path + '.br', brotli.compress(content))
+            _write(path, content)  # written last, so its presence means the variants are there too
+        else:
+            os.utime(path)  # still current: see _prune
+        manifest[name] = filename
+    _prune(app, manifest)
+    return manifest
+
+
+def _prune(app, manifest):
+    # Delete the bundles (and their .gz/.br variants and leftover temporary files) of earlier
+    # builds. A build touches the bundles it uses, so a file's age is the time since it was last
+    # current; files that stopped being current less than ASSET_PRUNE_AGE ago are kept for the
+    # pages rendered before a deploy and the workers that have not been restarted yet.
+    current = set(manifest.values())
+    cutoff = time.time() - app.config['ASSET_PRUNE_AGE']
+    for entry in os.scandir(_dist_folder(app)):
+        match = BUNDLE_FILE.match(entry.name)
+        if match is None or match.group(1) in current:
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass  # pruned by another worker at the same time
+
+
+def _write(path, content):
+    # Write to a temporary name and rename, so concurrent workers never serve a partial file.
+    # The name is unique per process and thread, so writers of the same file never share one.
+    tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def init_app(app):
+    app.assets = build_bundles(app)
+
+    @app.template_global()
+    def asset_url(name):
+        return url_for('assets.asset', filename=app.assets[name])
+
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    folder = _dist_folder(current_app)
+    mimetype = 'text/css' if filename.endswith('.css') else 'text/javascript'
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[candidate] and \
+                os.path.exists(os.path.join(folder, filename + suffix)):
+            encoding = candidate
+            filename += suffix
+            break
+    response = send_from_directory(folder, filename, mimetype=mimetype, max_age=ONE_YEAR)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.after_app_request
+def compress_response(response):
+    # Compress rendered HTML on the fly; bundles are served precompressed by asset() above.
+    if response.mimetype != 'text/html' or response.direct_passthrough or \
+            response.is_streamed or response.content_encoding or \
+            response.status_code in (204, 304) or \
+            not request.accept_encodings['gzip']:
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=current_app.config['COMPRESS_LEVEL']))
+    response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@bp.cli.group()
+def assets():
+    """Static asset commands."""
+    pass
+
+
+@assets.command()
+def build():
+    """Build the fingerprinted asset bundles."""
+    for name, filename in build_bundles(current_app).items():
+        click.echo(f'{name} -> {filename}')
@@ -16,8 +16,6 @@ from the WTForms package, since the Flask-WTF extension does not provide customi
 '''
 
 from wtforms.validators import ValidationError, DataRequired, Email, EqualTo
-import sqlalchemy as sa
-from app import db
 from app.models import User
 
 
@@ -38,15 +36,11 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField(_l('Register'))
 
     def validate_username(self, username):
-        user = db.session.scalar(sa.select(User).where(
-            User.username == username.data))
-        if user is not None:
+        if User.is_taken('username', username.data):
             raise ValidationError(_('Please use a different username.'))
 
     def validate_email(self, email):
-        user = db.session.scalar(sa.select(User).where(
-            User.email == email.data))
-        if user is not None:
+        if User.is_taken('email', email.data):
             raise ValidationError(_('Please use a different email address.'))
         
     '''
@@ -43,6 +43,11 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password')
             return redirect(url_for('auth.login'))
+        if user.password_needs_rehash():
+            # The hash settings in Config changed since this password was stored; this is the only
+            # moment we have the plain password to upgrade the hash.
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
@@ -68,12 +73,32 @@ def register():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except sa.exc.IntegrityError:
+            # Taken by a registration that committed after the form was validated.
+            db.session.rollback()
+            if User.is_taken('username', form.username.data):
+                form.username.errors.append(_('Please use a different username.'))
+            else:
+                form.email.errors.append(_('Please use a different email address.'))
+            return render_template('auth/register.html', title='Register', form=form)
         flash('Congratulations, you are now a registered user!')
         return redirect(url_for('auth.login'))
     return render_template('auth/register.html', title='Register', form=form)
 
 
+@bp.route('/availability')
+def availability():
+    # Called by the registration form while the user types, e.g. /auth/availability?username=susan
+    # Usernames only: they are public anyway, emails are not and could be enumerated this way.
+    value = request.args.get('username')
+    if not value:
+        return {'error': 'username is required'}, 400
+    return {'field': 'username', 'value': value,
+            'available': not User.is_taken('username', value)}
+
+
 @bp.route('/reset_password_request', methods=['GET', 'POST'])
 def reset_password_request():
     if current_user.is_authenticated:
@@ -0,0 +1,100 @@
+# Bloom filters over the usernames and emails in the user table, kept in Redis.
+# A Bloom filter can say for certain that a value was never added, so most "is this username
+# taken?" checks are answered without a query. A "maybe" is confirmed against the database
+# (see User.is_taken). Like app/search.py, this module knows nothing about the models.
+
+from hashlib import blake2b
+import redis
+from flask import current_app
+from app import workers
+
+ADD = '''
+local added = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        for i = 1, #ARGV do
+            redis.call('SETBIT', key, ARGV[i], 1)
+        end
+        added = 1
+    end
+end
+return added
+'''
+
+
+def _key(field):
+    return f'bloom:user:{field}'
+
+
+def _scratch_key(field):
+    return _key(field) + ':building'
+
+
+def _positions(value):
+    # Double hashing: k positions derived from two 64-bit halves of one digest.
+    bits = current_app.config['AVAILABILITY_BLOOM_BITS']
+    digest = blake2b(value.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % bits
+            for i in range(current_app.config['AVAILABILITY_BLOOM_HASHES'])]
+
+
+def might_contain(field, value):
+    '''
+    False if value has certainly never been added to the filter, True if it may have been,
+    None if the filter is not available (not built yet, or Redis is down).
+    '''
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.exists(_key(field))
+        for position in _positions(value):
+            pipe.getbit(_key(field), position)
+        exists, *bits = pipe.execute()
+        if not exists:
+            if current_app.config['AVAILABILITY_AUTO_REBUILD']:
+                _request_rebuild()
+            return None
+    except redis.exceptions.RedisError:
+        return None
+    return all(bits)
+
+
+def add(field, value):
+    # Only touches a filter that exists: creating a partial one here would make it report
+    # every value that is not in it as certainly absent. A filter being rebuilt gets the value
+    # too, or it would be lost when the new filter replaces the current one.
+    try:
+        current_app.redis.eval(ADD, 2, _key(field), _scratch_key(field), *_positions(value))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def rebuild(field, read_values):
+    '''
+    Build the filter for field in a scratch key from the iterable that read_values() returns,
+    then swap it in. read_values is only called once the scratch key exists, so every value
+    committed from then on reaches the new filter through add(), whether or not the read sees it.
+    '''
+    scratch = _scratch_key(field)
+    pipe = current_app.redis.pipeline(transaction=False)
+    pipe.delete(scratch)
+    # Allocate the whole bitmap up front so the filter exists even for an empty table.
+    pipe.setbit(scratch, current_app.config['AVAILABILITY_BLOOM_BITS'] - 1, 0)
+    pipe.execute()
+    count = 0
+    for value in read_values():
+        for position in _positions(value):
+            pipe.setbit(scratch, position, 1)
+        count += 1
+        if count % 1000 == 0:
+            pipe.execute()
+    pipe.rename(scratch, _key(field))
+    pipe.execute()
+    return count
+
+
+def _request_rebuild():
+    # At most one rebuild job at a time, however many requests notice the filter is missing.
+    if current_app.redis.set('bloom:user:rebuilding', 1, nx=True, ex=600):
+        workers.enqueue('rebuild_availability')
@@ -0,0 +1,89 @@
+# Locally generated avatars.
+# Each user gets a GitHub-style identicon (a mirrored 5x5 grid in a colour taken from the
+# user's email digest) instead of a Gravatar link. Images are rendered once per digest and size,
+# cached on disk and served from our own domain with immutable cache headers. Only digests of
+# existing users and the sizes in AVATAR_SIZES are rendered, so the cache cannot be made to grow
+# without bound; other digests get a plain default image.
+
+import os
+import struct
+import threading
+import zlib
+from flask import current_app
+
+BACKGROUND = (240, 240, 240)
+
+
+def _png(width, height, rows):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + row for row in rows)  # filter type 0 on every scanline
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 9)) + \
+        chunk(b'IEND', b'')
+
+
+def identicon(digest, size):
+    '''Return a size x size PNG identicon for a hex digest.'''
+    data = bytes.fromhex(digest)
+    # Keep the colour away from the background by limiting each channel to 30..209.
+    colour = bytes(30 + b % 180 for b in data[:3])
+    background = bytes(BACKGROUND)
+
+    cell = size // 6
+    margin = (size - 5 * cell) // 2
+    rows = []
+    for y in range(5):
+        # Three columns decided by the digest bits, mirrored to five.
+        half = [(data[3 + (y * 3 + x) // 8] >> ((y * 3 + x) % 8)) & 1 for x in range(3)]
+        cells = half + half[1::-1]
+        row = background * margin + \
+            b''.join((colour if on else background) * cell for on in cells)
+        row += background * (size - len(row) // 3)
+        rows.append(row)
+    blank = background * size
+    scanlines = [blank] * margin
+    for row in rows:
+        scanlines += [row] * cell
+    scanlines += [blank] * (size - len(scanlines))
+    return _png(size, size, scanlines)
+
+
+def default_avatar(size):
+    '''Return a size x size PNG of the background colour only.'''
+    return _png(size, size, [bytes(BACKGROUND) * size] * size)
+
+
+def _cached(name, render):
+    folder = current_app.config['AVATAR_CACHE_DIR']
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        # One temporary name per thread: threads rendering the same image at the same time each
+        # rename a complete file of their own, and whichever rename comes last wins.
+        tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(render())
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return path
+
+
+def avatar_path(digest, size):
+    '''Path of the cached PNG for digest and size, rendering it first if needed.'''
+    return _cached(f'{digest}-{size}.png', lambda: identicon(digest, size))
+
+
+def cached_avatar_path(digest, size):
+    '''Path of the PNG for digest and size if it has been rendered already, else None.'''
+    path = os.path.join(current_app.config['AVATAR_CACHE_DIR'], f'{digest}-{size}.png')
+    return path if os.path.exists(path) else None
+
+
+def default_avatar_path(size):
+    return _cached(f'default-{size}.png', lambda: default_avatar(size))
@@ -1,6 +1,16 @@
+import csv
+import itertools
 import os
-from flask import Blueprint
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, current_app
+from werkzeug.security import generate_password_hash, check_password_hash
 import click
+import redis
+import sqlalchemy as sa
+from app import db, workers, scheduler, sharding, dataset, loadtest, ratelimit, trending
+from app.passwords import verify_password
+from app.models import User, Post
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -38,3 +48,357 @@ def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
         raise RuntimeError('compile command failed')
+
+
+@bp.cli.group()
+def availability():
+    """Username and email availability filters."""
+    pass
+
+
+@availability.command()
+def rebuild():
+    """Rebuild the availability Bloom filters from the user table."""
+    for field, count in User.rebuild_availability().items():
+        click.echo(f'{field}: {count} values')
+
+
+@bp.cli.group('ratelimit')
+def ratelimit_group():
+    """Rate limiting."""
+    pass
+
+
+@ratelimit_group.command('stats')
+def ratelimit_stats():
+    """Show the allowed and limited requests per rate-limited endpoint."""
+    try:
+        metrics = ratelimit.get_metrics()
+    except redis.exceptions.RedisError as e:
+        raise click.ClickException(f'cannot read the counters from Redis: {e}')
+    for endpoint, counts in sorted(metrics.items()):
+        allowed, limited = counts.get('allowed', 0), counts.get('limited', 0)
+        share = 100 * limited / (allowed + limited) if allowed + limited else 0
+        click.echo(f'{endpoint:<28} {allowed:>10} allowed {limited:>10} limited ({share:.1f}%)')
+
+
+@bp.cli.group('typeahead')
+def typeahead_group():
+    """Username typeahead index."""
+    pass
+
+
+@typeahead_group.command('rebuild')
+def rebuild_typeahead():
+    """Rebuild the username prefix index from the user table."""
+    click.echo(f'{User.rebuild_typeahead()} users indexed')
+
+
+@bp.cli.group('trending')
+def trending_group():
+    """Trending posts and hot authors."""
+    pass
+
+
+@trending_group.command('update')
+def trending_update():
+    """Run one update of the trending lists right away."""
+    Post.update_trending()
+
+
+@bp.cli.group()
+def suggestions():
+    """Who to follow suggestions."""
+    pass
+
+
+@suggestions.command('update')
+def suggestions_update():
+    """Recompute the suggestions for every user from the follower graph."""
+    start = time.perf_counter()
+    count = User.update_suggestions()
+    click.echo(f'{count} users in {time.perf_counter() - start:.1f}s')
+
+
+@bp.cli.group()
+def follows():
+    """Follower graph maintenance."""
+    pass
+
+
+@follows.command('import')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8'))
+@click.option('--chunk-size', default=0,
+              help='Rows per transaction (default: FOLLOW_IMPORT_CHUNK).')
+def follows_import(csv_file, chunk_size):
+    """Import follower,followed username pairs from a CSV file."""
+    chunk_size = chunk_size or current_app.config['FOLLOW_IMPORT_CHUNK']
+    rows = (row for row in csv.reader(csv_file)
+            if len(row) >= 2 and row[:2] != ['follower', 'followed'])
+    imported = skipped = 0
+    while True:
+        chunk = [(follower.strip(), followed.strip())
+                 for follower, followed, *_ in itertools.islice(rows, chunk_size)]
+        if not chunk:
+            break
+        # One query to resolve the usernames and one INSERT for the edges of each chunk.
+        ids = User.ids_for_usernames({name for row in chunk for name in row})
+        edges = [(ids[follower], ids[followed]) for follower, followed in chunk
+                 if follower in ids and followed in ids and follower != followed]
+        User.add_follows(edges)
+        db.session.commit()
+        imported += len(edges)
+        skipped += len(chunk) - len(edges)
+        click.echo(f'{imported} edges imported, {skipped} rows with unknown users or self-follows skipped')
+
+
+@bp.cli.group('tags')
+def tags_group():
+    """Hashtags and mentions."""
+    pass
+
+
+@tags_group.command('link')
+@click.option('--chunk-size', default=0,
+              help='Posts per transaction (default: TAG_LINK_CHUNK).')
+def tags_link(chunk_size):
+    """Record the hashtags and mentions of existing posts (no notifications)."""
+    chunk_size = chunk_size or current_app.config['TAG_LINK_CHUNK']
+    click.echo(f'{Post.link_existing(chunk_size)} posts linked')
+
+
+@bp.cli.group('workers')
+def workers_group():
+    """Background task workers."""
+    pass
+
+
+@workers_group.command('start', with_appcontext=False)
+@click.option('--queue', '-q', 'queues', multiple=True, metavar='NAME=COUNT',
+              help='Workers for a queue, e.g. -q bulk=2 (default: TASK_QUEUES).')
+def workers_start(queues):
+    """Start the warm worker pool for the task queues."""
+    # Importing app.tasks builds the application the jobs run in (and pushes its context);
+    # the workers inherit it already initialised.
+    from app import tasks
+    pools = dict(tasks.app.config['TASK_QUEUES'])
+    for option in queues:
+        name, _, count = option.partition('=')
+        if name not in pools or not count.isdigit():
+            raise click.BadParameter(f'expected one of {", ".join(pools)} and a count',
+                                     param_hint='--queue')
+        pools[name] = int(count)
+    workers.run_pool(tasks.app, {name: count for name, count in pools.items() if count})
+
+
+@bp.cli.group('scheduler')
+def scheduler_group():
+    """Periodic tasks."""
+    pass
+
+
+@scheduler_group.command('run')
+@click.option('--once', is_flag=True, help='Enqueue the tasks that are due and exit.')
+def scheduler_run(once):
+    """Enqueue the tasks in SCHEDULE as they become due."""
+    if once:
+        for task_name in scheduler.run_due():
+            click.echo(f'enqueued {task_name}')
+    else:
+        scheduler.run_forever()
+
+
+@scheduler_group.command('status')
+def scheduler_status():
+    """Show when each scheduled task runs next."""
+    for task_name, interval, due_in in scheduler.status():
+        click.echo(f'{task_name}: every {interval}s, next in {due_in}s')
+
+
+@bp.cli.group('shards')
+def shards_group():
+    """Databases that posts and messages are sharded over."""
+    pass
+
+
+@shards_group.command('create')
+def shards_create():
+    """Create the sharded tables on every shard in SHARDS."""
+    sharding.create_all()
+    click.echo(f'tables created on {", ".join(current_app.config["SHARDS"]) or "no shards"}')
+
+
+@shards_group.command('rebalance')
+@click.option('--chunk-size', default=0,
+              help='Rows per copy/delete round (default: SHARD_REBALANCE_CHUNK).')
+def shards_rebalance(chunk_size):
+    """Move posts and messages to the shard they belong to under the current SHARDS."""
+    try:
+        moved = sharding.rebalance(chunk_size or current_app.config['SHARD_REBALANCE_CHUNK'])
+    except sharding.ShardingError as e:
+        raise click.ClickException(str(e))
+    for table, count in moved.items():
+        click.echo(f'{table}: {count} rows moved')
+
+
+@shards_group.command('status')
+def shards_status():
+    """Count the sharded rows on every shard."""
+    for shard in sharding.shards():
+        counts = [f'{model.__tablename__} {sharding.count(sa.select(model.id), [shard])}'
+                  for model in sharding.SHARDED_MODELS]
+        click.echo(f'{shard or "main"}: {", ".join(counts)}')
+
+
+@bp.cli.group('data')
+def data_group():
+    """Whole-dataset export and import."""
+    pass
+
+
+def _rate(name, count, seconds):
+    return f'{name}: {count} rows in {seconds:.1f}s ({count / max(seconds, 0.001):.0f} rows/s)'
+
+
+@data_group.command('export')
+@click.argument('directory')
+@click.option('--batch-size', default=0, help='Rows per fetch (default: DATA_BATCH_SIZE).')
+def data_export(directory, batch_size):
+    """Export users, follows, conversations, posts and messages to DIRECTORY."""
+    batch_size = batch_size or current_app.config['DATA_BATCH_SIZE']
+    for name, count, seconds in dataset.export(directory, batch_size):
+        click.echo(_rate(name, count, seconds))
+
+
+@data_group.command('import')
+@click.argument('directory')
+@click.option('--batch-size', default=0, help='Rows per INSERT (default: DATA_BATCH_SIZE).')
+@click.option('--transaction-rows', default=0,
+              help='Rows per transaction (default: DATA_TRANSACTION_ROWS).')
+def data_import(directory, batch_size, transaction_rows):
+    """Import an export made with flask data export into an empty database."""
+    batch_size = batch_size or current_app.config['DATA_BATCH_SIZE']
+    transaction_rows = transaction_rows or current_app.config['DATA_TRANSACTION_ROWS']
+    try:
+        for name, count, seconds in dataset.import_(directory, batch_size, transaction_rows):
+            click.echo(_rate(name, count, seconds))
+    except dataset.DatasetError as e:
+        raise click.ClickException(str(e))
+    # What the imported rows skipped on the way in: search indexing (live and archived posts),
+    # the availability filters, username completion and the trending lists.
+    if current_app.elasticsearch:
+        start = time.monotonic()
+        click.echo(_rate('search index', Post.reindex(), time.monotonic() - start))
+    try:
+        User.rebuild_availability()
+    except redis.exceptions.RedisError as e:
+        click.echo(f'availability filters not rebuilt ({e}); run flask availability rebuild')
+    try:
+        trending.reset()
+        for task in ('rebuild_typeahead', 'update_trending'):
+            workers.enqueue(task)
+    except redis.exceptions.RedisError as e:
+        click.echo(f'typeahead and trending not updated ({e}); run flask typeahead rebuild '
+                   'and flask trending update')
+
+
+@bp.cli.command('loadtest')
+@click.option('--clients', default=20, help='Virtual users running at the same time.')
+@click.option('--processes', default=1, help='Client processes the virtual users are spread over.')
+@click.option('--duration', default=30.0, help='Seconds to run.')
+@click.option('--think', default=0.0, help='Mean pause between two journeys of a user, in seconds.')
+@click.option('--mix', default='', help='Journey weights, e.g. timeline=30,post=10,search=5 '
+              f'(journeys: {", ".join(loadtest.JOURNEYS)}).')
+@click.option('--users', default=0, help='Seeded users to log in as (default: LOADTEST_USERS).')
+@click.option('--url', default='', help='Load an instance that is already running instead of '
+              'serving one; it must use this database.')
+@click.option('--ratelimits/--no-ratelimits', default=False,
+              help='Enforce RATELIMITS in the served instance (all clients share one IP).')
+@click.option('--cleanup', is_flag=True,
+              help='Delete the loadtest users and everything they wrote afterwards.')
+@click.option('--yes', is_flag=True, help='Do not ask before writing to the database.')
+def loadtest_command(clients, processes, duration, think, mix, users, url, ratelimits, cleanup,
+                     yes):
+    """Replay a mix of user journeys concurrently and report latencies per endpoint."""
+    app = current_app._get_current_object()
+    try:
+        mix = loadtest.parse_mix(mix) if mix else loadtest.DEFAULT_MIX
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    users = users or app.config['LOADTEST_USERS']
+    if not yes:
+        click.confirm(f'This writes loadtest users and posts to '
+                      f'{db.engine.url.render_as_string(hide_password=True)}. Continue?',
+                      abort=True)
+    start = time.monotonic()
+    usernames = loadtest.seed(users, app.config['LOADTEST_POSTS_PER_USER'],
+                              app.config['LOADTEST_FOLLOWS_PER_USER'])
+    click.echo(f'{len(usernames)} users seeded in {time.monotonic() - start:.1f}s')
+    server = None
+    if not url:
+        app.config['RATELIMIT_ENABLED'] = ratelimits
+        url, server = loadtest.serve(app)
+    click.echo(f'{clients} clients in {processes} process(es) against {url} for {duration:.0f}s')
+    try:
+        stats, elapsed = loadtest.run(url, usernames, mix, clients, processes, duration, think)
+    finally:
+        if server is not None:
+            server.shutdown()
+    click.echo(f'{"route":<28} {"requests":>8} {"req/s":>8} {"errors":>7} {"429":>6} '
+               f'{"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for row in loadtest.report(stats, elapsed):
+        click.echo(f'{row["route"]:<28} {row["requests"]:>8} {row["rps"]:>8.1f} '
+                   f'{row["errors"]:>6.1f}% {row["limited"]:>5.1f}% {row["p50"]:>8.1f} '
+                   f'{row["p90"]:>8.1f} {row["p99"]:>8.1f} {row["max"]:>8.1f}')
+    if cleanup:
+        count = loadtest.cleanup(app.config['MAINTENANCE_CHUNK_SIZE'])
+        click.echo(f'{count} loadtest users deleted; run flask typeahead rebuild to drop them '
+                   'from username completion')
+
+
+@bp.cli.group()
+def benchmark():
+    """Performance benchmarks."""
+    pass
+
+
+@benchmark.command()
+@click.option('--seconds', default=5.0, help='Duration of each run.')
+@click.option('--concurrency', default=0,
+              help='Simultaneous logins for the pooled run (default: twice the pool size).')
+def passwords(seconds, concurrency):
+    """Measure password verifications (logins) per second."""
+    app = current_app._get_current_object()
+    workers = app.config['PASSWORD_HASH_WORKERS'] or 1
+    concurrency = concurrency or 2 * workers
+    pwhash = generate_password_hash('benchmark', app.config['PASSWORD_HASH_METHOD'])
+    click.echo(f'method: {app.config["PASSWORD_HASH_METHOD"]}, '
+               f'pool: {app.config["PASSWORD_HASH_WORKERS"]} processes')
+
+    # Single core, in-process.
+    count, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        check_password_hash(pwhash, 'benchmark')
+        count += 1
+    inline_rate = count / (time.perf_counter() - start)
+    click.echo(f'in-process: {inline_rate:.1f} logins/s (1 core)')
+
+    # Through the process pool, from several request threads at once.
+    def login_loop(deadline):
+        done = 0
+        with app.app_context():
+            verify_password(pwhash, 'benchmark')  # start-up of the pool is not measured
+            while time.perf_counter() < deadline:
+                verify_password(pwhash, 'benchmark')
+                done += 1
+        return done
+
+    with app.app_context():
+        verify_password(pwhash, 'benchmark')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        total = sum(executor.map(login_loop, [start + seconds] * concurrency))
+    pooled_rate = total / (time.perf_counter() - start)
+    cores = min(workers, os.cpu_count() or 1)
+    click.echo(f'pooled: {pooled_rate:.1f} logins/s, '
+               f'{pooled_rate / cores:.1f} logins/s per core ({cores} cores)')
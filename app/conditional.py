@@ -0,0 +1,55 @@
+# Conditional GET support (ETag / Last-Modified).
+# A view builds its validators from a couple of indexed lookups, asks not_modified() whether the
+# client's copy is still good, and only renders the template when it is not.
+
+from hashlib import sha1
+from time import time
+from flask import current_app, g, request, session
+from flask_login import current_user
+
+
+def make_etag(*parts):
+    return sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def viewer_state(with_forms=False):
+    '''
+    The parts of a page that depend on who is looking at it rather than on the page itself:
+    the language, the unread message badge and the task progress alerts rendered by base.html.
+    '''
+    state = [current_user.id, g.locale]
+    if with_forms:
+        # Pages with forms embed a signed CSRF token. Rolling the ETag over every half
+        # token lifetime keeps a cached copy from outliving its token.
+        lifetime = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+        state.append(int(time() // (lifetime / 2)))
+    return state
+
+
+def page_state(with_forms=False):
+    return viewer_state(with_forms) + [
+        current_user.unread_message_count(),
+        tuple(task.id for task in current_user.get_tasks_in_progress()),
+    ]
+
+
+def not_modified(etag, last_modified=None, shows_flashes=True):
+    '''Return a 304 response if the client's validators still match, otherwise None.'''
+    if shows_flashes and session.get('_flashes'):
+        # A pending flash message has to be rendered, so the cached copy is not good enough.
+        return None
+    response = current_app.response_class()
+    add_validators(response, etag, last_modified)
+    response.make_conditional(request)
+    return response if response.status_code == 304 else None
+
+
+def add_validators(response, etag, last_modified=None):
+    response = current_app.make_response(response)
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # The pages are per user, so only the browser may keep them, and it has to revalidate each time.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
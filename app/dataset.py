@@ -0,0 +1,188 @@
+# Whole-dataset export and import (`flask data export` / `flask data import`).
+#
+# Every table is streamed to its own gzip-compressed NDJSON file, one JSON object per row,
+# read with a server-side cursor in batches, so memory use does not depend on the size of the
+# tables. Import reads the files back in the same order (a table only after the tables it
+# references) and writes batches of rows with one Core INSERT executemany each, committing
+# every DATA_TRANSACTION_ROWS rows; the ORM, and with it the per-commit search indexing, is not
+# involved. Sharded tables are read from every shard and written to the shard each row belongs
+# to under the current SHARDS, so an export can be imported with a different set of shards.
+#
+# On PostgreSQL and MySQL every database is read in one REPEATABLE READ transaction, so the
+# tables of the main database are a consistent snapshot of it even while the site is running
+# and the import can restore the foreign keys between them. The shards are separate databases
+# whose snapshots are taken at slightly different moments, and SQLite has no snapshot isolation
+# for this: there, export while nothing writes (stop the web and worker processes) to get
+# posts and messages that all have their users.
+
+import gzip
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+import sqlalchemy as sa
+from app import db, sharding
+from app.models import id_sequence
+
+TABLES = ['user', 'followers', 'conversation', 'participant', 'post', 'post_archive', 'message',
+          'post_tag', 'mention']
+MANIFEST = 'manifest.json'
+
+
+class DatasetError(RuntimeError):
+    pass
+
+
+def _path(directory, table_name):
+    return os.path.join(directory, f'{table_name}.ndjson.gz')
+
+
+def _sharded_model(table):
+    for model in sharding.SHARDED_MODELS:
+        if model.__table__ is table:
+            return model
+
+
+def _engines(table):
+    # (shard, engine) pairs a table is read from or written to.
+    if _sharded_model(table) is None:
+        return [(None, db.engine)]
+    return [(shard, sharding.engine(shard)) for shard in sharding.shards()]
+
+
+def _schema_revision():
+    try:
+        return db.session.scalar(sa.text('SELECT version_num FROM alembic_version'))
+    except sa.exc.DatabaseError:
+        db.session.rollback()
+        return None  # created with db.create_all(), as in the tests
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _snapshot(engine):
+    # A connection in a transaction that sees the database as it was when it started.
+    connection = engine.connect()
+    if engine.dialect.name in ('postgresql', 'mysql', 'mariadb'):
+        connection = connection.execution_options(isolation_level='REPEATABLE READ')
+    connection.begin()
+    return connection
+
+
+def export(directory, batch_size):
+    '''Write every table to directory; yields (table name, rows, seconds) as tables finish.'''
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    connections = {}
+    try:
+        for name in TABLES:
+            table = db.metadata.tables[name]
+            start = time.monotonic()
+            count = 0
+            with gzip.open(_path(directory, name), 'wt', encoding='utf-8') as f:
+                for shard, engine in _engines(table):
+                    if engine not in connections:
+                        connections[engine] = _snapshot(engine)
+                    result = connections[engine].execution_options(yield_per=batch_size).execute(
+                        sa.select(table).order_by(*table.primary_key.columns))
+                    for rows in result.mappings().partitions():
+                        f.writelines(json.dumps(dict(row), default=_encode) + '\n'
+                                     for row in rows)
+                        count += len(rows)
+            counts[name] = count
+            yield name, count, time.monotonic() - start
+    finally:
+        for connection in connections.values():
+            connection.close()
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump({'revision': _schema_revision(), 'tables': counts}, f, indent=2)
+
+
+def _decoder(table):
+    datetime_columns = [column.name for column in table.columns
+                        if isinstance(column.type, sa.DateTime)]
+
+    def decode(line):
+        row = json.loads(line)
+        for name in datetime_columns:
+            if row.get(name) is not None:
+                row[name] = datetime.fromisoformat(row[name])
+        return row
+    return decode
+
+
+def _check_target(manifest):
+    revision = _schema_revision()
+    if manifest['revision'] and revision and manifest['revision'] != revision:
+        raise DatasetError(f'the export was made at schema revision {manifest["revision"]}, '
+                           f'this database is at {revision}; run flask db upgrade/downgrade first')
+    for name in TABLES:
+        table = db.metadata.tables[name]
+        for shard, engine in _engines(table):
+            with engine.connect() as connection:
+                if connection.scalar(sa.select(sa.literal(1)).select_from(table).limit(1)):
+                    raise DatasetError(f'table {name} is not empty; import into an empty database')
+
+
+def _reset_sequences(table):
+    # The rows kept their ids. PostgreSQL's serial sequences do not know that, and the sharded
+    # tables' id_sequence rows (if any) have to start again after the imported ids. Deleting
+    # the row is enough for that: next_ids() seeds a missing row from max(id) over the shards.
+    with db.engine.begin() as connection:
+        connection.execute(sa.delete(id_sequence).where(id_sequence.c.name == table.name))
+    for shard, engine in _engines(table):
+        if engine.dialect.name != 'postgresql' or 'id' not in table.c:
+            continue
+        with engine.begin() as connection:
+            connection.execute(sa.text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                f'(SELECT coalesce(max(id), 0) + 1 FROM "{table.name}"), false)'),
+                {'table': f'"{table.name}"'})
+
+
+def import_(directory, batch_size, transaction_rows):
+    '''Load an export into this (empty) database; yields (table name, rows, seconds).'''
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    db.session.commit()
+    _check_target(manifest)
+    for name in TABLES:
+        table = db.metadata.tables[name]
+        model = _sharded_model(table)
+        decode = _decoder(table)
+        engines = dict(_engines(table))
+        connections = {}
+        start = time.monotonic()
+        count = pending = 0
+        try:
+            with gzip.open(_path(directory, name), 'rt', encoding='utf-8') as f:
+                rows = map(decode, f)
+                while batch := list(itertools.islice(rows, batch_size)):
+                    by_shard = {}
+                    for row in batch:
+                        shard = sharding.shard_for_row(model, row) if model else None
+                        by_shard.setdefault(shard, []).append(row)
+                    for shard, shard_rows in by_shard.items():
+                        if shard not in connections:
+                            connections[shard] = engines[shard].connect()
+                            connections[shard].begin()
+                        connections[shard].execute(sa.insert(table), shard_rows)
+                    count += len(batch)
+                    pending += len(batch)
+                    if pending >= transaction_rows:
+                        for connection in connections.values():
+                            connection.commit()
+                            connection.begin()
+                        pending = 0
+            for connection in connections.values():
+                connection.commit()
+        finally:
+            for connection in connections.values():
+                connection.close()
+        _reset_sequences(table)
+        yield name, count, time.monotonic() - start
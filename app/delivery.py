@@ -0,0 +1,135 @@
+# Realtime delivery of notifications through per-user Redis Streams.
+#
+# User.add_notification() queues an event on the session; once the transaction commits, the
+# event is appended to the user's stream (XADD with an approximate MAXLEN, so old entries are
+# trimmed as new ones arrive). Open pages read the stream through /events, a Server-Sent Events
+# endpoint. Every event carries its stream entry id as the SSE id, and browsers send the last one
+# back in a Last-Event-ID header when they reconnect, so a client resumes exactly where it
+# stopped: nothing is missed and nothing is delivered twice.
+#
+# The Notification table is still written, so /notifications keeps working for clients that
+# cannot use the stream.
+#
+# Every open stream holds a server worker, which only scales with async workers (gevent,
+# eventlet). /events is therefore off unless EVENTS_ENABLED is set; pages poll instead.
+
+import json
+import time
+import redis
+from flask import current_app
+
+
+# Raise the high-water mark, never lower it: commits do not finish in timestamp order.
+SET_MAX = '''
+local current = tonumber(redis.call('GET', KEYS[1]))
+if current == nil or tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+'''
+
+
+def _key(user_id):
+    return f'events:user:{user_id}'
+
+
+def _hwm_key(user_id):
+    return f'notifications:hwm:{user_id}'
+
+
+def publish(user_id, name, data, timestamp):
+    config = current_app.config
+    r = current_app.redis
+    # The high-water mark first, on its own: if it is not raised, /notifications would answer
+    # "nothing new" from it. Failing that, it is dropped so the database gets asked instead, and
+    # if Redis cannot even do that, the mark expires within NOTIFICATIONS_HWM_TTL seconds.
+    try:
+        r.eval(SET_MAX, 1, _hwm_key(user_id), repr(timestamp), config['NOTIFICATIONS_HWM_TTL'])
+    except redis.exceptions.RedisError:
+        try:
+            r.delete(_hwm_key(user_id))
+        except redis.exceptions.RedisError:
+            pass
+    try:
+        pipe = r.pipeline()
+        pipe.xadd(_key(user_id), {'name': name, 'data': json.dumps(data)},
+                  maxlen=config['EVENTS_STREAM_MAXLEN'], approximate=True)
+        # Streams of users that stopped coming back go away on their own.
+        pipe.expire(_key(user_id), config['EVENTS_STREAM_TTL'])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass  # open pages miss the event; they see it the next time they poll /notifications
+
+
+def high_water_mark(user_id):
+    '''
+    Timestamp of the user's newest notification, or None when it is not known (nothing recorded
+    recently, or Redis is down) and the database has to be asked.
+    '''
+    try:
+        value = current_app.redis.get(_hwm_key(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    return float(value) if value is not None else None
+
+
+def set_high_water_mark(user_id, timestamp):
+    # Seed a missing mark from the database. NX: a mark set by publish() is always at least as new.
+    try:
+        current_app.redis.set(_hwm_key(user_id), repr(timestamp), nx=True,
+                              ex=current_app.config['NOTIFICATIONS_HWM_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+
+
+def last_id(user_id):
+    '''The id of the newest event in the stream, where a new connection starts reading.'''
+    entries = current_app.redis.xrevrange(_key(user_id), count=1)
+    return entries[0][0].decode() if entries else '0-0'
+
+
+def _is_trimmed(user_id, after):
+    # The client's position is older than anything left in the stream, so entries it has not
+    # seen may have been trimmed. (It may also just have read the last entry before the oldest
+    # one kept; a needless reset only costs the client one /notifications request.)
+    if after == '0-0':
+        return False
+    entries = current_app.redis.xrange(_key(user_id), count=1)
+    return bool(entries) and _id_tuple(entries[0][0].decode()) > _id_tuple(after)
+
+
+def _id_tuple(entry_id):
+    ms, _, seq = entry_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
+def _format(entry_id, name, data):
+    return f'id: {entry_id}\nevent: {name}\ndata: {data}\n\n'
+
+
+def stream(user_id, after):
+    '''
+    Generate SSE frames for the events after the entry id after. It only uses Redis: the caller
+    should release its database session before streaming. The connection is closed after
+    EVENTS_CONNECTION_SECONDS so it does not hold a worker forever; the browser reconnects on its
+    own with Last-Event-ID. Reads are at most EVENTS_BATCH entries and the next read only happens
+    once the previous frames were written, so a slow client slows its own reads down instead of
+    making the server buffer events for it.
+    '''
+    config = current_app.config
+    deadline = time.monotonic() + config['EVENTS_CONNECTION_SECONDS']
+    # Ask the browser to wait a little before reconnecting.
+    yield f'retry: {config["EVENTS_RETRY_MS"]}\n\n'
+    if _is_trimmed(user_id, after):
+        # The client was away for so long that its position was trimmed away.
+        yield _format(last_id(user_id), 'reset', '{}')
+        after = last_id(user_id)
+    while time.monotonic() < deadline:
+        response = current_app.redis.xread({_key(user_id): after},
+                                           count=config['EVENTS_BATCH'],
+                                           block=config['EVENTS_BLOCK_MS'])
+        if not response:
+            yield ': keep-alive\n\n'
+            continue
+        for entry_id, fields in response[0][1]:
+            after = entry_id.decode()
+            yield _format(after, fields[b'name'].decode(), fields[b'data'].decode())
@@ -1,4 +1,4 @@
-from flask import render_template
+from flask import render_template, request
 from app import db
 from app.errors import bp
 
@@ -8,6 +8,18 @@ from app.errors import bp
 def not_found_error(error):
     return render_template('errors/404.html'), 404
 
+@bp.app_errorhandler(429)
+def too_many_requests(error):
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+    if request.is_json:
+        return {'error': 'rate limited', 'retry_after': error.retry_after}, 429, headers
+    return render_template('errors/429.html'), 429, headers
+
+@bp.app_errorhandler(503)
+def service_unavailable(error):
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+    return render_template('errors/503.html', error=error), 503, headers
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
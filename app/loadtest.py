@@ -0,0 +1,343 @@
+# Concurrent load generator (`flask loadtest`).
+#
+# Virtual users, each with its own HTTP session, log in and then replay a weighted mix of user
+# journeys (JOURNEYS) until the time is up: reading the timeline, posting, hovering over user
+# popups, polling notifications, searching. The application is served from a background thread
+# of the command itself (werkzeug's threaded server) unless a URL is given, so the whole stack
+# is exercised - SQLite locking, session commits, Redis - without any external tooling. Virtual
+# users run as threads, optionally spread over several client processes so the client side is
+# not limited by one interpreter's GIL.
+#
+# Every request is timed and recorded under its route (e.g. "GET /user/<username>/popup");
+# report() turns the recordings into throughput, latency percentiles and error rates.
+#
+# seed() and the posts written by the journeys go to the configured database, so the command asks
+# before it writes (or needs --yes), and cleanup() deletes the loadtest users again with
+# everything that refers to them.
+#
+# The client side of this module (everything after serve()) must not need an application
+# context: client processes are spawned fresh and only get a URL and usernames.
+
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+import requests
+import sqlalchemy as sa
+
+USERNAME_PREFIX = 'loadtest'
+PASSWORD = 'loadtest'
+TAGS = ['flask', 'python', 'sqlite', 'redis', 'loadtest']
+WORDS = ['hello', 'world', 'python', 'flask', 'post', 'today', 'coffee', 'release']
+
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+USERNAME_RE = re.compile(re.escape(USERNAME_PREFIX) + r'\d+')
+
+
+# Server side: data and the served instance.
+
+def _email(username):
+    return f'{username}@example.com'
+
+
+def seed(users, posts_per_user, follows_per_user, rng=None):
+    '''
+    Create the first `users` loadtest users (password PASSWORD) that do not exist yet, with
+    posts and random follows among them; returns all their usernames.
+    '''
+    from app import db
+    from app.models import User, Post
+    from app.passwords import hash_password
+
+    rng = rng or random.Random(0)
+    usernames = [f'{USERNAME_PREFIX}{i}' for i in range(users)]
+    existing = User.ids_for_usernames(usernames)
+    pwhash = hash_password(PASSWORD)  # one (slow) hash, shared by every seeded user
+    new_users = [User(username=username, email=_email(username), password_hash=pwhash)
+                 for username in usernames if username not in existing]
+    db.session.add_all(new_users)
+    db.session.flush()
+    posts = [Post(body=_post_body(rng, usernames), author=user)
+             for user in new_users for _ in range(posts_per_user)]
+    db.session.add_all(posts)
+    db.session.flush()
+    Post.link(posts, notify=False)
+    ids = list(User.ids_for_usernames(usernames).values())
+    User.add_follows([(user.id, followed_id) for user in new_users
+                      for followed_id in rng.sample(ids, min(follows_per_user, len(ids)))])
+    db.session.commit()
+    return usernames
+
+
+def cleanup(chunk_size):
+    '''
+    Delete every loadtest user (see seed()) with their posts, follows, mentions, notifications,
+    tasks and conversations, chunk_size users per transaction; returns the number of users.
+    '''
+    from app import db, sharding
+    from app.models import User, Post, ArchivedPost, Message, Conversation, Participant, \
+        Notification, Task, followers, post_tags, mentions
+    from app.search import remove_from_index_bulk
+
+    # Both the name and the email seed() gives them: a real account may be called loadtest7.
+    query = sa.select(User.id, User.username, User.email).where(
+        User.username.startswith(USERNAME_PREFIX))
+    ids = [user_id for user_id, username, email in db.session.execute(query)
+           if USERNAME_RE.fullmatch(username) and email == _email(username)]
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        for shard in sharding.shards():
+            for model in (Post, ArchivedPost):
+                post_ids = list(sharding.scalars(shard, sa.select(model.id).where(
+                    model.user_id.in_(chunk))))
+                if not post_ids:
+                    continue
+                db.session.execute(sa.delete(post_tags).where(post_tags.c.post_id.in_(post_ids)))
+                db.session.execute(sa.delete(mentions).where(mentions.c.post_id.in_(post_ids)))
+                sharding.execute(shard, sa.delete(model).where(model.id.in_(post_ids)))
+                if model is Post:
+                    remove_from_index_bulk(Post.__tablename__, post_ids)
+            sharding.execute(shard, sa.delete(Message).where(sa.or_(
+                Message.sender_id.in_(chunk), Message.recipient_id.in_(chunk))))
+        for statement in (
+                sa.delete(Participant).where(sa.or_(Participant.user_id.in_(chunk),
+                                                    Participant.other_user_id.in_(chunk))),
+                sa.delete(Conversation).where(sa.or_(Conversation.user1_id.in_(chunk),
+                                                     Conversation.user2_id.in_(chunk))),
+                sa.delete(mentions).where(mentions.c.user_id.in_(chunk)),
+                sa.delete(followers).where(sa.or_(followers.c.follower_id.in_(chunk),
+                                                  followers.c.followed_id.in_(chunk))),
+                sa.delete(Notification).where(Notification.user_id.in_(chunk)),
+                sa.delete(Task).where(Task.user_id.in_(chunk)),
+                sa.delete(User).where(User.id.in_(chunk))):
+            db.session.execute(statement)
+        db.session.commit()
+    return len(ids)
+
+
+def serve(app):
+    '''Serve app from a daemon thread on a free local port; returns (base URL, server).'''
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass  # one access log line per request would be most of the work
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+# Client side: virtual users and their journeys.
+
+def _post_body(rng, usernames):
+    return ' '.join(rng.sample(WORDS, 3) + ['#' + rng.choice(TAGS), '@' + rng.choice(usernames)])
+
+
+class Stats:
+    '''Latencies (seconds) and failures per route; merged across threads and processes.'''
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.limited = Counter()
+
+    def record(self, name, seconds, status):
+        self.latencies[name].append(seconds)
+        if status == 429:
+            self.limited[name] += 1
+        elif status is None or status >= 400:
+            self.errors[name] += 1
+
+    def merge(self, other):
+        for name, latencies in other.latencies.items():
+            self.latencies[name] += latencies
+        self.errors.update(other.errors)
+        self.limited.update(other.limited)
+        return self
+
+
+class _Client:
+    def __init__(self, base_url, stats):
+        self.base_url = base_url
+        self.stats = stats
+        self.http = requests.Session()
+
+    def request(self, name, method, path, expect=None, **kwargs):
+        # expect(response) -> False counts the response as an error whatever its status.
+        start = time.perf_counter()
+        try:
+            # Redirects are not followed: every request is timed on its own.
+            response = self.http.request(method, self.base_url + path, allow_redirects=False,
+                                         timeout=30, **kwargs)
+        except requests.RequestException:
+            response = None
+        status = response.status_code if response is not None else None
+        if response is not None and expect is not None and not expect(response):
+            status = None
+        self.stats.record(name, time.perf_counter() - start, status)
+        return response
+
+    def csrf_token(self, response):
+        match = CSRF_RE.search(response.text) if response is not None else None
+        return match.group(1) if match else ''
+
+
+def _logged_in(response):
+    # A failed login redirects as well, back to the login page.
+    return response.status_code == 302 and \
+        not response.headers.get('Location', '').split('?')[0].endswith('/auth/login')
+
+
+def _login(client, rng, username, usernames):
+    page = client.request('GET /auth/login', 'GET', '/auth/login')
+    response = client.request('POST /auth/login', 'POST', '/auth/login', expect=_logged_in, data={
+        'username': username, 'password': PASSWORD, 'csrf_token': client.csrf_token(page)})
+    return response is not None and _logged_in(response)
+
+
+def _timeline(client, rng, username, usernames):
+    client.request('GET /index', 'GET', '/index')
+
+
+def _explore(client, rng, username, usernames):
+    client.request('GET /explore', 'GET', '/explore')
+
+
+def _post(client, rng, username, usernames):
+    page = client.request('GET /index', 'GET', '/index')
+    client.request('POST /index', 'POST', '/index', data={
+        'post': _post_body(rng, usernames), 'csrf_token': client.csrf_token(page)})
+
+
+def _popup(client, rng, username, usernames):
+    client.request('GET /user/<username>/popup', 'GET', f'/user/{rng.choice(usernames)}/popup')
+
+
+def _notifications(client, rng, username, usernames):
+    client.request('GET /notifications', 'GET', '/notifications?since=0')
+
+
+def _search(client, rng, username, usernames):
+    client.request('GET /search', 'GET', '/search', params={'q': rng.choice(WORDS)})
+
+
+def _typeahead(client, rng, username, usernames):
+    client.request('GET /typeahead/users', 'GET', '/typeahead/users',
+                   params={'q': rng.choice(usernames)[:rng.randint(1, 9)]})
+
+
+def _tag(client, rng, username, usernames):
+    client.request('GET /tag/<name>', 'GET', f'/tag/{rng.choice(TAGS)}')
+
+
+JOURNEYS = {
+    'timeline': _timeline,
+    'explore': _explore,
+    'post': _post,
+    'popup': _popup,
+    'notifications': _notifications,
+    'search': _search,
+    'typeahead': _typeahead,
+    'tag': _tag,
+    'login': _login,
+}
+DEFAULT_MIX = {'timeline': 30, 'explore': 5, 'post': 10, 'popup': 20, 'notifications': 20,
+               'search': 5, 'typeahead': 5, 'tag': 5}
+
+
+def parse_mix(text):
+    '''"timeline=30,post=10" -> {'timeline': 30, 'post': 10}; ValueError if it is not valid.'''
+    mix = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        name, _, weight = item.partition('=')
+        if name not in JOURNEYS:
+            raise ValueError(f'unknown journey {name!r} (one of {", ".join(JOURNEYS)})')
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError('the mix needs at least one journey with a positive weight')
+    return mix
+
+
+def _virtual_user(base_url, username, usernames, mix, deadline, think, seed):
+    rng = random.Random(seed)
+    stats = Stats()
+    client = _Client(base_url, stats)
+    if not _login(client, rng, username, usernames):
+        return stats  # counted as an error of POST /auth/login
+    names, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        JOURNEYS[rng.choices(names, weights)[0]](client, rng, username, usernames)
+        if think:
+            time.sleep(rng.expovariate(1 / think))
+    return stats
+
+
+def _run_threads(base_url, assigned, usernames, mix, duration, think, seed):
+    # One process' share of the virtual users, one thread each.
+    deadline = time.monotonic() + duration
+    with ThreadPoolExecutor(max_workers=len(assigned), thread_name_prefix='loadtest') as executor:
+        results = executor.map(_virtual_user, [base_url] * len(assigned), assigned,
+                               [usernames] * len(assigned), [mix] * len(assigned),
+                               [deadline] * len(assigned), [think] * len(assigned),
+                               [seed + i for i in range(len(assigned))])
+        stats = Stats()
+        for result in results:
+            stats.merge(result)
+    return stats
+
+
+def run(base_url, usernames, mix, clients, processes, duration, think=0.0, seed=0):
+    '''
+    Run `clients` virtual users for `duration` seconds, spread over `processes` client
+    processes (1: threads of this process only). Returns (Stats, elapsed seconds).
+    '''
+    assigned = [usernames[i % len(usernames)] for i in range(clients)]
+    start = time.monotonic()
+    if processes <= 1:
+        stats = _run_threads(base_url, assigned, usernames, mix, duration, think, seed)
+    else:
+        shares = [assigned[i::processes] for i in range(processes)]
+        shares = [share for share in shares if share]
+        stats = Stats()
+        with ProcessPoolExecutor(max_workers=len(shares), mp_context=get_context('spawn')) as executor:
+            futures = [executor.submit(_run_threads, base_url, share, usernames, mix, duration,
+                                       think, seed + 1000 * i)
+                       for i, share in enumerate(shares)]
+            for future in futures:
+                stats.merge(future.result())
+    return stats, time.monotonic() - start
+
+
+def _percentile(ordered, p):
+    # Nearest rank.
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def report(stats, elapsed):
+    '''
+    One dict per route, busiest first, and a last one for all of them: requests, requests per
+    second, error and rate-limited percentages, and p50/p90/p99/max latency in milliseconds.
+    '''
+    rows = []
+    routes = sorted(stats.latencies, key=lambda name: -len(stats.latencies[name]))
+    everything = [latency for name in routes for latency in stats.latencies[name]]
+    for name, latencies, errors, limited in [
+            (name, stats.latencies[name], stats.errors[name], stats.limited[name]) for name in routes
+    ] + [('total', everything, sum(stats.errors.values()), sum(stats.limited.values()))]:
+        if not latencies:
+            continue
+        ordered = sorted(latencies)
+        rows.append({
+            'route': name,
+            'requests': len(ordered),
+            'rps': len(ordered) / elapsed,
+            'errors': 100 * errors / len(ordered),
+            'limited': 100 * limited / len(ordered),
+            **{f'p{p}': 1000 * _percentile(ordered, p) for p in (50, 90, 99)},
+            'max': 1000 * ordered[-1],
+        })
+    return rows
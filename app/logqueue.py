@@ -0,0 +1,207 @@
+# Logging that never blocks a request.
+#
+# app.logger gets QueueHandlers only: a logging call formats the record's message and puts it on
+# a queue, and background QueueListener threads do the slow part. One writes JSON lines to the
+# rotating log file, another sends the error mails, so a slow mail server holds up neither the
+# requests nor the log file. When a queue is full the record is dropped (and counted) rather than
+# making the request wait.
+#
+# Error mails are deduplicated and rate limited: an error raised again from the same place with
+# the same exception within ERROR_MAIL_DEDUP_WINDOW seconds is counted instead of mailed, and no
+# more than ERROR_MAIL_MAX_PER_HOUR mails go out per hour; the next mail says how many were left
+# out. An error storm therefore costs a handful of mails, not one per request.
+
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+from flask import has_request_context, request
+from flask.logging import default_handler
+
+_listeners = []
+_fork_hooks_installed = False
+
+
+class JSONFormatter(logging.Formatter):
+    '''One JSON object per record, with the request it was logged from, if any.'''
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'where': f'{record.pathname}:{record.lineno}',
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        for key in ('method', 'path', 'remote_addr'):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RequestQueueHandler(QueueHandler):
+    '''
+    Queues a copy of each record with its message already merged and the details of the
+    request added; both need the request thread, and so does formatting the traceback.
+    '''
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()  # the counter is updated from every request thread
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)  # other handlers may still see the original
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if has_request_context():
+            record.method = request.method
+            record.path = request.path
+            record.remote_addr = request.remote_addr
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            return
+        if not self.dropped:
+            return
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            notice = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                       '%d log records dropped: the log queue was full',
+                                       (dropped,), None)
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                with self._dropped_lock:
+                    self.dropped += dropped
+
+
+class ErrorMailHandler(SMTPHandler):
+    '''SMTPHandler that mails every distinct error once per window, within an hourly budget.'''
+
+    def __init__(self, *args, dedup_window, max_per_hour, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dedup_window = dedup_window
+        self.max_per_hour = max_per_hour
+        self._last_sent = {}  # error key -> (time of the last mail, repeats since)
+        self._sent = deque()  # times of the mails of the last hour
+        self._over_budget = 0
+
+    def _key(self, record):
+        # Where it was logged (for unhandled exceptions that is always the same line of Flask),
+        # the innermost frame of the traceback and the exception itself.
+        lines = record.exc_text.splitlines() if record.exc_text else []
+        frame = next((line for line in reversed(lines) if line.lstrip().startswith('File ')), '')
+        return record.pathname, record.lineno, frame, lines[-1] if lines else ''
+
+    def emit(self, record):
+        now = time.monotonic()
+        key = self._key(record)
+        last, repeats = self._last_sent.get(key, (None, 0))
+        if last is not None and now - last < self.dedup_window:
+            self._last_sent[key] = (last, repeats + 1)
+            return
+        while self._sent and now - self._sent[0] > 3600:
+            self._sent.popleft()
+        if len(self._sent) >= self.max_per_hour:
+            self._over_budget += 1
+            return
+        notes = []
+        if repeats:
+            notes.append(f'{repeats} more of this error since the last mail')
+        if self._over_budget:
+            notes.append(f'{self._over_budget} other errors were not mailed (hourly limit)')
+        if notes:
+            record.msg = f'{record.msg}\n\n' + '\n'.join(notes)
+        # Forget errors that are past their window, unless they have repeats still to report.
+        self._last_sent = {k: v for k, v in self._last_sent.items()
+                           if now - v[0] < self.dedup_window or v[1]}
+        self._last_sent[key] = (now, 0)
+        self._sent.append(now)
+        self._over_budget = 0
+        super().emit(record)
+
+
+def _start(app, handlers, level):
+    log_queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+    queue_handler = RequestQueueHandler(log_queue)
+    queue_handler.setLevel(level)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    app.logger.addHandler(queue_handler)
+    _listeners.append((queue_handler, listener))
+
+
+def _restart_after_fork():
+    # A forked child (a worker of the pool, a preforking server) inherits the queues but not the
+    # threads that empty them, and possibly a queue lock held by some other thread at the time.
+    for queue_handler, listener in _listeners:
+        log_queue = queue.Queue(maxsize=queue_handler.queue.maxsize)
+        queue_handler.queue = listener.queue = log_queue
+        listener._thread = None
+        listener.start()
+
+
+def _stop():
+    for queue_handler, listener in _listeners:
+        if listener._thread is not None:
+            listener.stop()  # writes out what is still queued
+
+
+def init_app(app):
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ErrorMailHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='Microblog Failure',
+            credentials=auth, secure=secure,
+            dedup_window=app.config['ERROR_MAIL_DEDUP_WINDOW'],
+            max_per_hour=app.config['ERROR_MAIL_MAX_PER_HOUR'])
+        mail_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+        _start(app, [mail_handler], logging.ERROR)
+
+    log_dir = os.path.dirname(app.config['LOG_FILE'])
+    if log_dir and not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+    file_handler = RotatingFileHandler(app.config['LOG_FILE'],
+                                       maxBytes=app.config['LOG_FILE_MAX_BYTES'],
+                                       backupCount=app.config['LOG_FILE_BACKUPS'])
+    file_handler.setFormatter(JSONFormatter())
+    # Flask's own stderr handler, if the logger has it, is moved behind the queue as well.
+    stderr_handlers = [default_handler] if default_handler in app.logger.handlers else []
+    app.logger.removeHandler(default_handler)
+    _start(app, [file_handler] + stderr_handlers, logging.INFO)
+
+    global _fork_hooks_installed
+    if not _fork_hooks_installed:
+        os.register_at_fork(after_in_child=_restart_after_fork)
+        atexit.register(_stop)
+        _fork_hooks_installed = True
@@ -13,9 +13,7 @@ The above classes that represent the field types that I'm using for this form ar
 from the WTForms package, since the Flask-WTF extension does not provide customized versions.
 '''
 from wtforms.validators import ValidationError, DataRequired, Length
-import sqlalchemy as sa
 from flask_babel import _, lazy_gettext as _l
-from app import db
 from app.models import User
 from flask import request
 
@@ -32,9 +30,7 @@ class EditProfileForm(FlaskForm):
 
     def validate_username(self, username):
         if username.data != self.original_username:
-            user = db.session.scalar(sa.select(User).where(
-                User.username == username.data))
-            if user is not None:
+            if User.is_taken('username', username.data):
                 raise ValidationError(_('Please use a different username.'))
 
 
@@ -1,26 +1,44 @@
+import asyncio
+import json
+import re
 from datetime import datetime, timezone
+from markupsafe import Markup, escape
 from flask import render_template, flash, redirect, url_for, request, session, g, \
-current_app
+current_app, abort, send_file, stream_with_context
 from flask_login import current_user, login_required
 
+import redis
 import sqlalchemy as sa
-from app import db
-from app.models import User, Post, Message, Notification
+from app import db, trending, delivery, archive, sharding, typeahead
+from app.models import User, Post, Message, Notification, Conversation, Participant, \
+    HASHTAG_RE, MENTION_RE, post_tags, mentions
 from urllib.parse import urlsplit
+from elasticsearch import ApiError, TransportError
 
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
 
 from flask_babel import _, get_locale
 from langdetect import detect, LangDetectException
-from app.translate import translate
+from app.translate import translate_async, translate_batch
+from app.avatars import avatar_path, cached_avatar_path, default_avatar_path
+from app.conditional import make_etag, page_state, viewer_state, not_modified, add_validators
+from app.relationships import relationship, prefetch as prefetch_relationships
 
 from app.main import bp
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        now = datetime.now(timezone.utc)
+        last_seen = current_user.last_seen
+        if last_seen is not None and last_seen.tzinfo is None:
+            last_seen = last_seen.replace(tzinfo=timezone.utc)
+        # Only write last_seen once per LAST_SEEN_RESOLUTION, so most requests can be served
+        # from the cached user without touching the user row.
+        if last_seen is None or (now - last_seen).total_seconds() > \
+                current_app.config['LAST_SEEN_RESOLUTION']:
+            current_user.last_seen = now
+            db.session.commit()
         g.search_form = SearchForm()
     
     g.locale = str(get_locale())
@@ -38,6 +56,8 @@ def index():
             language = ''
         post = Post(body=form.post.data, author=current_user, language=language)
         db.session.add(post)
+        db.session.flush()  # the tags and mentions need the post's id
+        Post.link([post])
         db.session.commit()
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
@@ -55,7 +75,8 @@ def index():
         is not a POST request anymore, and the refresh command works in a more predictable way.
         '''
     page = request.args.get('page', 1, type=int)
-    pagination_obj = db.paginate(current_user.following_posts(), page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    query_for, shards = current_user.timeline()
+    pagination_obj = archive.paginate(query_for, page, current_app.config['POSTS_PER_PAGE'], shards)
     posts = pagination_obj.items
     
     next_url = url_for('main.index', page=pagination_obj.next_num) \
@@ -63,7 +84,9 @@ def index():
     prev_url = url_for('main.index', page=pagination_obj.prev_num) \
         if pagination_obj.has_prev else None
     
-    return render_template('index.html', title='Home', posts = posts, form = form, next_url=next_url, prev_url=prev_url)
+    suggested = current_user.suggested_users(current_app.config['SUGGESTIONS_SHOWN'])
+    return render_template('index.html', title='Home', posts = posts, form = form, next_url=next_url, prev_url=prev_url,
+                           suggested=suggested)
 
 
 @bp.route('/explore')
@@ -71,14 +94,62 @@ def index():
 def explore():
     
     page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    pagination_obj = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    if request.args.get('mode') == 'trending':
+        try:
+            return _explore_trending(page)
+        except redis.exceptions.RedisError:
+            flash(_('Trending posts are not available right now.'))
+    latest = _latest_post(sa.select(Post.id, Post.timestamp), sharding.shards())
+    etag = make_etag('explore', page, latest, page_state())
+    last_modified = latest.timestamp if latest else None
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+
+    pagination_obj = archive.paginate(
+        lambda model: sa.select(model).order_by(model.timestamp.desc(), model.id.desc()),
+        page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.explore', page=pagination_obj.next_num) \
         if pagination_obj.has_next else None
     prev_url = url_for('main.explore', page=pagination_obj.prev_num) \
         if pagination_obj.has_prev else None
     posts = pagination_obj.items
-    return render_template("index.html", title='Explore', posts=posts, next_url=next_url, prev_url=prev_url)
+    return add_validators(
+        render_template("index.html", title='Explore', posts=posts, next_url=next_url, prev_url=prev_url,
+                        mode='latest'),
+        etag, last_modified)
+
+
+def _explore_trending(page):
+    # The ranking is precomputed by the update_trending task; a page is one ZREVRANGE plus
+    # two primary key lookups, and it only changes when the task finishes a run.
+    per_page = current_app.config['POSTS_PER_PAGE']
+    etag = make_etag('trending', page, trending.get_version(), page_state())
+    response = not_modified(etag)
+    if response:
+        return response
+
+    ids, total = trending.get_posts(page, per_page)
+    posts, total = Post._from_ids(ids, total)
+    author_ids = trending.get_authors(current_app.config['TRENDING_AUTHORS_SHOWN'])
+    rank = {id: i for i, id in enumerate(author_ids)}
+    authors = sorted(db.session.scalars(sa.select(User).where(User.id.in_(author_ids))),
+                     key=lambda user: rank[user.id])
+    next_url = url_for('main.explore', mode='trending', page=page + 1) \
+        if total > page * per_page else None
+    prev_url = url_for('main.explore', mode='trending', page=page - 1) \
+        if page > 1 else None
+    return add_validators(
+        render_template('index.html', title=_('Trending'), posts=posts, authors=authors,
+                        next_url=next_url, prev_url=prev_url, mode='trending'),
+        etag, None)
+
+
+def _latest_post(query, shards):
+    # Newest (id, timestamp) of a listing; served from the post.timestamp index with a LIMIT 1
+    # on each of the shards.
+    found = sharding.gather(query.order_by(Post.timestamp.desc(), Post.id.desc()), shards, 0, 1)
+    return found[0][1] if found else None
 
 
 @bp.route('/user/<username>')
@@ -87,18 +158,46 @@ def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
     # In the case that there are no results, the db.first_or_404 method automatically sends a 404 error back to the client.
     page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    pagination_obj = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
+    shards = [sharding.shard_for(user.id)]
+    latest = _latest_post(sa.select(Post.id, Post.timestamp).where(Post.user_id == user.id), shards)
+    etag = make_etag('user', user.id, user.version, user.last_seen, latest, relationship(user),
+                     page, page_state(with_forms=True))
+    last_modified = max(filter(None, [user.last_seen, latest.timestamp if latest else None]),
+                        default=None)
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+
+    pagination_obj = archive.paginate(user.own_posts, page, current_app.config['POSTS_PER_PAGE'], shards)
     posts = pagination_obj.items
     next_url = url_for('main.user', username=user.username, page=pagination_obj.next_num) \
         if pagination_obj.has_next else None
     prev_url = url_for('main.user', username=user.username, page=pagination_obj.prev_num) \
         if pagination_obj.has_prev else None
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts,
-                           next_url=next_url, prev_url=prev_url, form=form)
+    return add_validators(
+        render_template('user.html', user=user, posts=posts,
+                        next_url=next_url, prev_url=prev_url, form=form),
+        etag, last_modified)
+
+
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    # The image only depends on the URL, so browsers and proxies may keep it forever.
+    if not re.fullmatch('[0-9a-f]{32}', digest) or size not in current_app.config['AVATAR_SIZES']:
+        abort(404)
+    path = cached_avatar_path(digest, size)
+    if path is None:
+        if db.session.scalar(sa.select(User.id).where(User.avatar_hash == digest).limit(1)) is None:
+            # Not (yet) anyone's: a default image that is neither cached here nor for long,
+            # since the digest may belong to a user who registers later.
+            return send_file(default_avatar_path(size), mimetype='image/png', max_age=3600)
+        path = avatar_path(digest, size)
+    response = send_file(path, mimetype='image/png',
+                         max_age=current_app.config['AVATAR_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -108,7 +207,14 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        current_user.bump_version()
+        try:
+            db.session.commit()
+        except sa.exc.IntegrityError:
+            # Taken by a registration or rename that committed after the form was validated.
+            db.session.rollback()
+            form.username.errors.append(_('Please use a different username.'))
+            return render_template('edit_profile.html', title='Edit Profile', form=form)
         flash('Your changes have been saved.')
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -161,23 +267,55 @@ def unfollow(username):
     
 
 
+@bp.route('/following', methods=['POST', 'DELETE'])
+@login_required
+def follow_many():
+    # POST {"usernames": [...]} follows all of them, DELETE unfollows them.
+    data = request.get_json(silent=True) or {}
+    usernames = data.get('usernames')
+    if not isinstance(usernames, list) or not all(isinstance(u, str) for u in usernames):
+        return {'error': 'usernames must be a list of strings'}, 400
+    if len(usernames) > current_app.config['FOLLOW_BULK_MAX']:
+        return {'error': f'at most {current_app.config["FOLLOW_BULK_MAX"]} usernames per request'}, 400
+    ids = User.ids_for_usernames(usernames)
+    if request.method == 'POST':
+        changed = current_user.follow_many(ids.values())
+    else:
+        changed = current_user.unfollow_many(ids.values())
+    db.session.commit()
+    return {
+        'followed' if request.method == 'POST' else 'unfollowed':
+            sorted(name for name, id in ids.items() if id in changed),
+        'not_found': sorted(set(usernames) - set(ids)),
+    }
+
+
 @bp.route('/translate', methods=['POST'])
 @login_required
-def translate_text():
+async def translate_text():
+    # Async view: Flask runs it through asgiref, so the upstream calls of a batch run concurrently.
     data = request.get_json()
-    return {'text': translate(data['text'],
-                              data['source_language'],
-                              data['dest_language'])}
+    if 'texts' in data:
+        return {'texts': await translate_batch(data['texts'],
+                                               data['source_language'],
+                                               data['dest_language'])}
+    return {'text': await translate_async(data['text'],
+                                          data['source_language'],
+                                          data['dest_language'])}
 
 
 @bp.route('/search')
 @login_required
-def search():
+async def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
+    try:
+        posts, total = await Post.search_async(g.search_form.q.data, page,
+                                               current_app.config['POSTS_PER_PAGE'])
+    except (asyncio.TimeoutError, ApiError, TransportError):
+        flash(_('Search is not available right now, please try again later.'))
+        posts, total = [], 0
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -186,13 +324,129 @@ def search():
                            next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/tag/<name>')
+@login_required
+def tag(name):
+    name = name.lower()
+    return _linked_posts(post_tags, post_tags.c.tag, name, '#' + name, 'main.tag', name=name)
+
+
+@bp.route('/mentions')
+@login_required
+def mentions_of_me():
+    return _linked_posts(mentions, mentions.c.user_id, current_user.id,
+                         _('Mentions of %(username)s', username=current_user.username),
+                         'main.mentions_of_me')
+
+
+def _linked_posts(table, column, value, title, endpoint, **args):
+    # Keyset pagination: ?before=<id of the last post shown>, so a page costs the same however
+    # deep it is and new posts never shift the ones on the next page.
+    before = request.args.get('before', type=int)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    posts = Post.linked(table, column, value, before, per_page + 1)
+    next_url = url_for(endpoint, before=posts[per_page - 1].id, **args) \
+        if len(posts) > per_page else None
+    return render_template('linked_posts.html', title=title, posts=posts[:per_page],
+                           next_url=next_url)
+
+
+_LINK_RE = re.compile(f'{HASHTAG_RE.pattern}|{MENTION_RE.pattern}')
+
+
+@bp.app_template_filter('linkify')
+def linkify(body):
+    # A post body with its hashtags and mentions turned into links; the text in between is
+    # escaped, so the links are the only markup in the result.
+    html, end = [], 0
+    for match in _LINK_RE.finditer(body):
+        tag, username = match.groups()
+        url = url_for('main.tag', name=tag.lower()) if tag else url_for('main.user', username=username)
+        html += [escape(body[end:match.start()]),
+                 Markup('<a href="{}">{}</a>').format(url, match.group())]
+        end = match.end()
+    html.append(escape(body[end:]))
+    return Markup('').join(html)
+
+
+@bp.route('/typeahead/users')
+@login_required
+def username_typeahead():
+    # Called by the search box and the post form while the user types, e.g. /typeahead/users?q=su
+    prefix = request.args.get('q', '').strip().lstrip('@')
+    if not prefix:
+        return {'users': []}
+    limit = current_app.config['TYPEAHEAD_RESULTS']
+    users = typeahead.lookup(prefix, limit)
+    if users is None:
+        # No index to ask (or a prefix longer than the indexed ones): the username index in
+        # the database can answer too, without the ranking.
+        users = db.session.execute(
+            sa.select(User.username, User.avatar_hash)
+            .where(User.username.startswith(prefix, autoescape=True))
+            .order_by(User.username).limit(limit)).all()
+    return {'users': [{'username': username,
+                       'avatar': url_for('main.avatar', digest=avatar_hash, size=36)}
+                      for username, avatar_hash in users]}
+
+
+@bp.route('/user/<username>/followers', defaults={'kind': 'followers'})
+@bp.route('/user/<username>/following', defaults={'kind': 'following'})
+@login_required
+def follow_list(username, kind):
+    user = db.first_or_404(sa.select(User).where(User.username == username))
+    before = request.args.get('before', type=int)
+    per_page = current_app.config['USERS_PER_PAGE']
+    ids = _follow_list_ids(user, kind, before, per_page + 1)
+    # One extra row tells whether there is a next page without counting.
+    next_url = url_for('main.follow_list', username=username, kind=kind,
+                       before=ids[per_page - 1]) if len(ids) > per_page else None
+    ids = ids[:per_page]
+    rank = {id: i for i, id in enumerate(ids)}
+    users = sorted(db.session.scalars(sa.select(User).where(User.id.in_(ids))),
+                   key=lambda u: rank[u.id])
+    prefetch_relationships(users)
+    title = _('Followers of %(username)s', username=username) if kind == 'followers' \
+        else _('Followed by %(username)s', username=username)
+    return render_template('follow_list.html', title=title, user=user, users=users,
+                           kind=kind, next_url=next_url, form=EmptyForm())
+
+
+def _follow_list_ids(user, kind, before, limit):
+    # The first page of a popular account is what everyone looks at; keep it in Redis under the
+    # user's version, which every follow and unfollow bumps, so it never goes stale.
+    if before is not None:
+        return user.follow_list_ids(kind, before, limit)
+    key = f'follow-list:{kind}:{user.id}:{user.version}:{limit}'
+    try:
+        cached = current_app.redis.get(key)
+        if cached is not None:
+            return [int(id) for id in cached.split(b',') if id]
+    except redis.exceptions.RedisError:
+        return user.follow_list_ids(kind, before, limit)
+    ids = user.follow_list_ids(kind, before, limit)
+    if len(ids) == limit:
+        try:
+            current_app.redis.set(key, ','.join(str(id) for id in ids),
+                                  ex=current_app.config['FOLLOW_LIST_CACHE_TTL'])
+        except redis.exceptions.RedisError:
+            pass
+    return ids
+
+
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
     # The above raises a 404 HTTP error if no result is found
+    etag = make_etag('popup', user.id, user.version, user.last_seen, relationship(user),
+                     viewer_state(with_forms=True))
+    response = not_modified(etag, user.last_seen, shows_flashes=False)
+    if response:
+        return response
     form = EmptyForm() # for follow and unfollow
-    return render_template('user_popup.html', user=user, form=form)
+    return add_validators(render_template('user_popup.html', user=user, form=form),
+                          etag, user.last_seen)
 
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
@@ -203,46 +457,145 @@ def send_message(recipient):
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        db.session.commit()
-        flash(_('Your message has been sent.'))
+        Conversation.record(msg)
+        # Same transaction as the message: the count includes it once the session autoflushes.
         user.add_notification('unread_message_count',
                               user.unread_message_count())
         db.session.commit()
-        return redirect(url_for('main.user', username=recipient))
+        flash(_('Your message has been sent.'))
+        return redirect(url_for('main.conversation', username=recipient))
     return render_template('send_message.html', title=_('Send Message'),
                            form=form, recipient=recipient)
 
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.now(timezone.utc)
-    current_user.add_notification('unread_message_count', 0)
-    db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['POSTS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
-                           next_url=next_url, prev_url=prev_url)
+    before = request.args.get('before', type=int)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    rows = Participant.inbox(current_user, before, per_page + 1)
+    conversations = [row for row in rows[:per_page] if row[2] is not None]
+    next_url = None
+    if len(rows) > per_page:
+        # Continue after the last conversation shown, or the last one of the page if none was.
+        last = conversations[-1] if conversations else rows[per_page - 1]
+        next_url = url_for('main.messages', before=last[0].last_message_id)
+    return render_template('messages.html', conversations=conversations, next_url=next_url)
+
+
+@bp.route('/messages/<username>')
+@login_required
+def conversation(username):
+    user = db.first_or_404(sa.select(User).where(User.username == username))
+    conversation = Conversation.between(current_user, user)
+    before = request.args.get('before', type=int)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    messages, next_url = [], None
+    if conversation is not None:
+        participant = conversation.participant(current_user)
+        if participant.unread_count or participant.last_read_message_id != participant.last_message_id:
+            participant.mark_read()
+            current_user.add_notification('unread_message_count',
+                                          current_user.unread_message_count())
+            db.session.commit()
+        messages = conversation.messages(before, per_page + 1)
+        if len(messages) > per_page:
+            next_url = url_for('main.conversation', username=username,
+                               before=messages[per_page - 1].id)
+        messages = messages[:per_page]
+    form = MessageForm()
+    return render_template('conversation.html', title=_('Conversation with %(username)s', username=username),
+                           user=user, messages=messages, next_url=next_url, form=form)
 
 
 @bp.route('/notifications')
 @login_required
 def notifications():
-    since = request.args.get('since', 0.0, type=float)
-    query = current_user.notifications.select().where(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    notifications = db.session.scalars(query)
-    return [{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications]
+    # ?since=<timestamp> as before, or ?cursor=<next> from the previous response to continue
+    # a listing that was cut at the limit.
+    since, after_id = request.args.get('since', 0.0, type=float), None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            since, after_id = float(cursor.split('_')[0]), int(cursor.split('_')[1])
+        except (ValueError, IndexError):
+            return {'error': 'invalid cursor'}, 400
+
+    # Most polls find nothing new; answer those from Redis without touching the database.
+    hwm = delivery.high_water_mark(current_user.id)
+    if hwm is None:
+        hwm = db.session.scalar(sa.select(sa.func.max(Notification.timestamp)).where(
+            Notification.user_id == current_user.id)) or 0.0
+        delivery.set_high_water_mark(current_user.id, hwm)
+    # The mark is a timestamp only: a cursor that stopped at it may still have rows with that
+    # same timestamp and a higher id to go.
+    if since > hwm or (since == hwm and after_id is None):
+        return _notifications_response([], None)
+
+    limit = max(1, min(request.args.get('limit', current_app.config['NOTIFICATIONS_LIMIT'], type=int),
+                       current_app.config['NOTIFICATIONS_LIMIT']))
+    newer = Notification.timestamp > since
+    if after_id is not None:
+        newer = sa.or_(newer, sa.and_(Notification.timestamp == since, Notification.id > after_id))
+    query = sa.select(Notification.id, Notification.name, Notification.payload_json,
+                      Notification.timestamp).where(Notification.user_id == current_user.id, newer) \
+        .order_by(Notification.timestamp.asc(), Notification.id.asc()).limit(limit + 1)
+    rows = db.session.execute(query).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = f'{rows[-1].timestamp!r}_{rows[-1].id}' if more else None
+    return _notifications_response(_latest_task_progress(rows), next_cursor)
+
+
+def _latest_task_progress(rows):
+    # Only the newest progress of each task matters to the client.
+    latest, kept = {}, []
+    for row in reversed(rows):
+        if row.name == 'task_progress':
+            task_id = json.loads(row.payload_json).get('task_id')
+            if task_id in latest:
+                continue
+            latest[task_id] = True
+        kept.append(row)
+    return kept[::-1]
+
+
+def _notifications_response(rows, next_cursor):
+    # payload_json is already JSON: splice it in rather than decoding and re-encoding it.
+    items = ','.join(
+        f'{{"id":{row.id},"name":{json.dumps(row.name)},"data":{row.payload_json},'
+        f'"timestamp":{row.timestamp!r}}}' for row in rows)
+    body = f'{{"notifications":[{items}],"next":{json.dumps(next_cursor)}}}'
+    return current_app.response_class(body, mimetype='application/json')
+
+
+@bp.route('/events')
+@login_required
+def events():
+    # Server-Sent Events stream of the current user's notifications (see app/delivery.py).
+    if not current_app.config['EVENTS_ENABLED']:
+        abort(503, description=_('Realtime updates are not available right now.'))
+    after = request.headers.get('Last-Event-ID') or request.args.get('after', '')
+    try:
+        if not re.fullmatch(r'\d+-\d+', after):
+            after = delivery.last_id(current_user.id)
+        frames = delivery.stream(current_user.id, after)
+        first = next(frames)
+    except redis.exceptions.RedisError:
+        abort(503, description=_('Realtime updates are not available right now.'))
+
+    def generate():
+        yield first
+        try:
+            yield from frames
+        except redis.exceptions.RedisError:
+            pass  # the browser reconnects, and falls back to polling if that fails
+
+    # The stream only needs Redis; give the database connection back to the pool instead of
+    # keeping it checked out for as long as the stream is open.
+    db.session.remove()
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @bp.route('/export_posts')
@@ -1,16 +1,22 @@
+from collections import defaultdict
 from datetime import datetime, timezone
+from functools import partial
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from app import db, login
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.ext.hybrid import hybrid_property
+from app import db, login, user_cache, availability, trending, suggestions, delivery, workers, \
+    sharding, typeahead
+from app.passwords import hash_password, verify_password, needs_rehash
 from flask_login import UserMixin
 from hashlib import md5
 from time import time
 import jwt
-from flask import current_app as app
-from app.search import add_to_index, remove_from_index, query_index
+from flask import current_app as app, url_for
+from app.search import add_to_index, add_to_index_bulk, remove_from_index, query_index, \
+    query_index_async
 import json
+import re
 import redis
 import rq
 
@@ -18,6 +24,15 @@ class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
         ids, total = query_index(cls.__tablename__, expression, page, per_page)   
+        return cls._from_ids(ids, total)
+
+    @classmethod
+    async def search_async(cls, expression, page, per_page):
+        ids, total = await query_index_async(cls.__tablename__, expression, page, per_page)
+        return cls._from_ids(ids, total)
+
+    @classmethod
+    def _from_ids(cls, ids, total):
         if total == 0:
             return [], 0
         when = []
@@ -56,8 +71,12 @@ class SearchableMixin(object):
 
     @classmethod
     def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+        # Bulk requests over a streamed query: used after imports, which skip the per-commit
+        # indexing above. Returns the number of documents indexed.
+        shards = sharding.shards() if cls in sharding.SHARDED_MODELS else [None]
+        return sum(add_to_index_bulk(cls.__tablename__, sharding.scalars(
+                       shard, sa.select(cls).execution_options(yield_per=1000)))
+                   for shard in shards)
 
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
@@ -75,9 +94,33 @@ to the model class, set to the desired name as a string.
 followers = db.Table('followers',
                      db.metadata,
                      sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'),primary_key=True),
-                     sa.Column('followed_id',sa.Integer, sa.ForeignKey('user.id'), primary_key=True)
+                     sa.Column('followed_id',sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+                     # The primary key covers "who does X follow"; this covers "who follows X".
+                     sa.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
                      )
 
+# Hashtags and @mentions found in post bodies: a word after # or @ that does not continue
+# another word ("a#b" and "me@example.com" are neither). Rows carry the post's timestamp so a
+# timeline is a range scan of the index, in the main database whichever shard the post is on.
+HASHTAG_RE = re.compile(r'(?<![\w#@])#(\w+)')
+MENTION_RE = re.compile(r'(?<![\w#@])@(\w+)')
+
+post_tags = db.Table('post_tag',
+                     db.metadata,
+                     sa.Column('tag', sa.String(64), primary_key=True),
+                     sa.Column('post_id', sa.Integer, primary_key=True),
+                     sa.Column('timestamp', sa.DateTime, nullable=False),
+                     sa.Index('ix_post_tag_tag_timestamp_post_id', 'tag', 'timestamp', 'post_id')
+                     )
+
+mentions = db.Table('mention',
+                    db.metadata,
+                    sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+                    sa.Column('post_id', sa.Integer, primary_key=True),
+                    sa.Column('timestamp', sa.DateTime, nullable=False),
+                    sa.Index('ix_mention_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id')
+                    )
+
 class User(UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True) 
     #so.Mapped: Provides precise type information for ORM-mapped attributes.
@@ -87,6 +130,9 @@ class User(UserMixin, db.Model):
     we have done above. The mapped_column() function can infer the datatype from the type hint.
     '''
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True, unique=True)
+    avatar_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True)
+    # md5 of the email, stored so rendering avatars never has to hash anything; indexed because
+    # /avatar only renders images for digests that belong to a user
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
     #Optional: Optional typing hint from Python indicates that an attribute can be None.
     posts: so.WriteOnlyMapped['Post'] = so.relationship(
@@ -116,13 +162,16 @@ class User(UserMixin, db.Model):
         back_populates='user')
     
     tasks: so.WriteOnlyMapped['Task'] = so.relationship(back_populates='user')
+
+    version: so.Mapped[int] = so.mapped_column(default=1, server_default='1')
+    # Bumped whenever something shown on the profile or popup changes (profile fields, follow counts),
+    # so views can build an ETag from it without re-reading that data.
     
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(Message.recipient == self,
-                                         Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(
-            query.subquery()))
+        # Summed from the per-conversation counters, so the badge on every page never has to
+        # look at the messages themselves, which may be spread over several shards.
+        return db.session.scalar(sa.select(sa.func.coalesce(sa.func.sum(Participant.unread_count), 0))
+                                 .where(Participant.user_id == self.id))
     
     
     '''
@@ -144,14 +193,77 @@ class User(UserMixin, db.Model):
     '''
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
+        self.bump_version()
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
-    
+        return verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return needs_rehash(self.password_hash)
+
+    @classmethod
+    def is_taken(cls, field, value):
+        # The Bloom filter answers "certainly not taken" from Redis; anything else is
+        # settled by the indexed lookup on the column.
+        if availability.might_contain(field, value) is False:
+            return False
+        column = getattr(cls, field)
+        return db.session.scalar(sa.select(cls.id).where(column == value)) is not None
+
+    @classmethod
+    def rebuild_availability(cls):
+        counts = {}
+        for field in ('username', 'email'):
+            column = getattr(cls, field)
+            # Registrations and renames committed while the filter is built are added to it by
+            # availability.add(), so the read can start whenever rebuild() is ready for it.
+            counts[field] = availability.rebuild(field, lambda: db.session.scalars(
+                sa.select(column).execution_options(yield_per=1000)))
+        return counts
+
+    @classmethod
+    def rebuild_typeahead(cls):
+        counts = sa.select(followers.c.followed_id, sa.func.count().label('count')) \
+            .group_by(followers.c.followed_id).subquery()
+
+        def users(*conditions):
+            return db.session.execute(
+                sa.select(cls.id, cls.username, cls.avatar_hash, sa.func.coalesce(counts.c.count, 0))
+                .outerjoin(counts, counts.c.followed_id == cls.id).where(*conditions)
+                .execution_options(yield_per=1000))
+
+        def changed(ids):
+            # A new transaction, so what was committed during the bulk read is visible.
+            db.session.commit()
+            return users(cls.id.in_(ids))
+        return typeahead.rebuild(users, changed)
+
+    @classmethod
+    def update_suggestions(cls):
+        edge_count = db.session.scalar(sa.select(sa.func.count()).select_from(followers))
+        rows = db.session.execute(
+            sa.select(followers.c.follower_id, followers.c.followed_id)
+            .execution_options(yield_per=10000))
+        graph, ids = suggestions.load_graph(edge_count, rows.partitions())
+        return suggestions.store(suggestions.compute(graph, ids))
+
+    def suggested_users(self, count):
+        # Suggestions are precomputed, so drop anyone followed since the last run.
+        ids = suggestions.get(self.id)[:count]
+        if not ids:
+            return []
+        query = sa.select(User).where(User.id.in_(ids), User.id.not_in(
+            sa.select(followers.c.followed_id).where(followers.c.follower_id == self.id)))
+        return sorted(db.session.scalars(query), key=lambda user: ids.index(user.id))
+
+    @so.validates('email')
+    def _update_avatar_hash(self, key, email):
+        self.avatar_hash = md5(email.lower().encode('utf-8')).hexdigest()
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return url_for('main.avatar', digest=self.avatar_hash, size=size)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
@@ -160,17 +272,90 @@ class User(UserMixin, db.Model):
     which is going to be useful for debugging.
     '''
 
+    def bump_version(self):
+        if sa.inspect(self).has_identity:
+            # Incremented by the database, like bump_versions(): two transactions that bump the
+            # same user get different versions, however old the copy each of them started from.
+            self.version = User.version + 1
+        else:
+            self.version = (self.version or 0) + 1
+
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self.bump_version()
+            user.bump_version()
     
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.bump_version()
+            user.bump_version()
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
+
+    def follow_list_ids(self, kind, before=None, limit=None):
+        '''
+        Ids of the users following this user (kind='followers') or followed by it
+        (kind='following'), highest id first. Keyset pagination: pass the last id of the previous
+        page as before, so every page is an index range scan however deep it is.
+        '''
+        if kind == 'followers':
+            this, other = followers.c.followed_id, followers.c.follower_id
+        else:
+            this, other = followers.c.follower_id, followers.c.followed_id
+        query = sa.select(other).where(this == self.id)
+        if before is not None:
+            query = query.where(other < before)
+        return list(db.session.scalars(query.order_by(other.desc()).limit(limit)))
+
+    # Bulk versions of follow() and unfollow(): a constant number of statements however many
+    # users are involved, instead of an is_following() SELECT and an INSERT/DELETE per user.
+
+    @classmethod
+    def ids_for_usernames(cls, usernames):
+        query = sa.select(cls.username, cls.id).where(cls.username.in_(set(usernames)))
+        return dict(db.session.execute(query).all())
+
+    def _following_ids(self, user_ids):
+        query = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id, followers.c.followed_id.in_(user_ids))
+        return set(db.session.scalars(query))
+
+    def follow_many(self, user_ids):
+        '''Follow every user in user_ids; returns the ids that were not followed before.'''
+        new_ids = set(user_ids) - self._following_ids(user_ids) - {self.id}
+        User.add_follows((self.id, user_id) for user_id in new_ids)
+        return new_ids
+
+    def unfollow_many(self, user_ids):
+        '''Unfollow every user in user_ids; returns the ids that were followed before.'''
+        old_ids = self._following_ids(user_ids)
+        if old_ids:
+            db.session.execute(sa.delete(followers).where(
+                followers.c.follower_id == self.id, followers.c.followed_id.in_(old_ids)))
+            User.bump_versions(old_ids | {self.id})
+        return old_ids
+
+    @classmethod
+    def add_follows(cls, edges):
+        '''Insert (follower_id, followed_id) edges in one statement, skipping existing ones.'''
+        edges = [{'follower_id': follower_id, 'followed_id': followed_id}
+                 for follower_id, followed_id in edges if follower_id != followed_id]
+        if not edges:
+            return
+        db.session.execute(_insert_ignoring_duplicates(followers), edges)
+        cls.bump_versions({edge['follower_id'] for edge in edges} |
+                          {edge['followed_id'] for edge in edges})
+
+    @classmethod
+    def bump_versions(cls, user_ids):
+        # Set-based bump_version(); the cached snapshots are dropped when the session commits.
+        db.session.execute(sa.update(cls).where(cls.id.in_(user_ids))
+                           .values(version=cls.version + 1))
+        db.session.info.setdefault('stale_user_ids', set()).update(user_ids)
     
     def followers_count(self):
         query = sa.select(sa.func.count()).select_from(self.followers.select().subquery())
@@ -184,20 +369,41 @@ class User(UserMixin, db.Model):
         # Whenever a query is included as part of a larger query, SQLAlchemy requires the inner query to be converted to a sub-query by calling the subquery() method.
         return db.session.scalar(query)
     
-    def following_posts(self):
+    def following_posts(self, model=None, author_ids=None):
+        # model=ArchivedPost builds the same timeline over the archive table. With shards the
+        # posts cannot be joined with followers, which stays in the main database; they are
+        # selected by author_ids instead (see timeline()).
+        model = model or Post
+        if author_ids is not None:
+            return (sa.select(model).where(model.user_id.in_(author_ids))
+                    .order_by(model.timestamp.desc(), model.id.desc()))
         Author = so.aliased(User)
         Follower = so.aliased(User)
         return (
-            sa.select(Post)
-            .join(Post.author.of_type(Author))
+            sa.select(model)
+            .join(model.author.of_type(Author))
             .join(Author.followers.of_type(Follower), isouter=True)
             .where(sa.or_(
                 Follower.id == self.id,
                 Author.id == self.id,
             ))
-            .group_by(Post)
-            .order_by(Post.timestamp.desc())
+            .group_by(model)
+            .order_by(model.timestamp.desc(), model.id.desc())
         )
+
+    def timeline(self):
+        '''(query_for, shards) of the home page, as archive.paginate() takes them.'''
+        if not sharding.enabled():
+            return self.following_posts, sharding.shards()
+        author_ids = set(db.session.scalars(
+            sa.select(followers.c.followed_id).where(followers.c.follower_id == self.id)))
+        author_ids.add(self.id)
+        return partial(self.following_posts, author_ids=author_ids), sharding.shards_for(author_ids)
+
+    def own_posts(self, model=None):
+        model = model or Post
+        return (sa.select(model).where(model.user_id == self.id)
+                .order_by(model.timestamp.desc(), model.id.desc()))
     
     '''
     The joined table now has all the posts, so I can expand the where() clause to include both posts from followed 
@@ -223,13 +429,14 @@ class User(UserMixin, db.Model):
     
     def add_notification(self, name, data):
         db.session.execute(self.notifications.delete().where(Notification.name==name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
+        n = Notification(name=name, payload_json=json.dumps(data), user=self, timestamp=time())
         db.session.add(n)
+        # Pushed to the user's event stream once the transaction commits (see app/delivery.py).
+        db.session.info.setdefault('pending_events', []).append((self.id, name, data, n.timestamp))
         return n
     
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = app.task_queue.enqueue(f'app.tasks.{name}', self.id,
-                                                *args, **kwargs)
+        rq_job = workers.enqueue(name, self.id, *args, **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description,
                     user=self)
         db.session.add(task)
@@ -244,6 +451,7 @@ class User(UserMixin, db.Model):
                                           Task.complete == False)
         return db.session.scalar(query)
 
+@sharding.sharded
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
 
@@ -267,8 +475,190 @@ class Post(SearchableMixin, db.Model):
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+    @hybrid_property
+    def shard_user_id(self):
+        return self.user_id if self.user_id is not None else self.author.id
+
+    @shard_user_id.inplace.expression
+    @classmethod
+    def _shard_user_id_expression(cls):
+        return cls.user_id
+
+    @classmethod
+    def reindex(cls):
+        # The archived posts as well, into the post index where their search hits are expected.
+        return super().reindex() + sum(
+            add_to_index_bulk(cls.__tablename__, sharding.scalars(
+                shard, sa.select(ArchivedPost).execution_options(yield_per=1000)))
+            for shard in sharding.shards())
+
+    @classmethod
+    def _from_ids(cls, ids, total):
+        # Ids do not say which shard a post is on, so every shard is asked. Search results can
+        # also point at archived posts; those are loaded from the archive.
+        if total == 0:
+            return [], 0
+        posts = sharding.load(cls, ids)
+        missing = set(ids) - {post.id for post in posts}
+        if missing:
+            posts += sharding.load(ArchivedPost, missing)
+        rank = {id: i for i, id in enumerate(ids)}
+        posts.sort(key=lambda post: rank[post.id])
+        return posts, total
+
+    @staticmethod
+    def extract_links(body):
+        '''The hashtags (lowercased) and mentioned usernames in body, each once, in order.'''
+        tags = [tag.lower() for tag in HASHTAG_RE.findall(body) if len(tag) <= 64]
+        return list(dict.fromkeys(tags)), list(dict.fromkeys(MENTION_RE.findall(body)))
+
+    @classmethod
+    def link(cls, posts, notify=True):
+        '''
+        Record the hashtags and mentions of posts (anything with id, body, timestamp and
+        user_id, flushed posts or rows) and, with notify, tell the users they mention. Rows that
+        exist already are left alone, so posts can be linked again. Returns the rows written.
+        '''
+        tag_rows, mentioned = [], []
+        for post in posts:
+            tags, usernames = cls.extract_links(post.body)
+            tag_rows += [{'tag': tag, 'post_id': post.id, 'timestamp': post.timestamp}
+                         for tag in tags]
+            mentioned += [(post, username) for username in usernames]
+        user_ids = User.ids_for_usernames({username for post, username in mentioned}) \
+            if mentioned else {}
+        mention_rows = [{'user_id': user_ids[username], 'post_id': post.id,
+                         'timestamp': post.timestamp}
+                        for post, username in mentioned if username in user_ids]
+        if tag_rows:
+            db.session.execute(_insert_ignoring_duplicates(post_tags), tag_rows)
+        if mention_rows:
+            db.session.execute(_insert_ignoring_duplicates(mentions), mention_rows)
+        if notify:
+            for post, username in mentioned:
+                if username in user_ids and user_ids[username] != post.user_id:
+                    author = db.session.get(User, post.user_id)
+                    db.session.get(User, user_ids[username]).add_notification(
+                        'mention', {'post_id': post.id, 'author': author.username})
+        return len(tag_rows) + len(mention_rows)
+
+    @classmethod
+    def link_existing(cls, chunk_size):
+        '''
+        Link every post, live and archived, on every shard, chunk_size posts per transaction,
+        without notifications. Returns the number of posts read.
+        '''
+        count = 0
+        for model in (Post, ArchivedPost):
+            columns = [model.id, model.body, model.timestamp, model.user_id]
+            for shard in sharding.shards():
+                last_id = 0
+                while True:
+                    rows = sharding.execute(shard, sa.select(*columns).where(model.id > last_id)
+                                            .order_by(model.id).limit(chunk_size)).all()
+                    if not rows:
+                        break
+                    cls.link(rows, notify=False)
+                    db.session.commit()
+                    count += len(rows)
+                    last_id = rows[-1].id
+        return count
+
+    @classmethod
+    def linked(cls, table, column, value, before, limit):
+        '''
+        Up to limit posts with a row in table (post_tags or mentions) whose column is value,
+        newest first, starting after the post with id before (keyset pagination).
+        '''
+        query = sa.select(table.c.post_id).where(column == value)
+        if before is not None:
+            timestamp = db.session.scalar(sa.select(table.c.timestamp)
+                                          .where(column == value, table.c.post_id == before))
+            if timestamp is not None:
+                query = query.where(sa.tuple_(table.c.timestamp, table.c.post_id) < (timestamp, before))
+        ids = db.session.scalars(query.order_by(table.c.timestamp.desc(), table.c.post_id.desc())
+                                 .limit(limit)).all()
+        return cls._from_ids(ids, len(ids))[0]
+
+    @classmethod
+    def update_trending(cls):
+        # Score the posts and messages created since the previous run (see app/trending.py).
+        now = time()
+        state = trending.get_state(now)
+        since = max(now - app.config['TRENDING_WINDOW'],
+                    state['last_run'] - app.config['TRENDING_OVERLAP'])
+        since = datetime.fromtimestamp(since, timezone.utc)
+        batch = app.config['TRENDING_BATCH_SIZE']
+
+        for shard in sharding.shards():
+            after = 0
+            while True:
+                posts = sharding.execute(shard,
+                    sa.select(cls.id, cls.user_id, cls.timestamp)
+                    .where(cls.timestamp >= since, cls.id > after)
+                    .order_by(cls.id).limit(batch)).all()
+                if not posts:
+                    break
+                # One grouped count for all the authors in the batch.
+                follower_counts = dict(db.session.execute(
+                    sa.select(followers.c.followed_id, sa.func.count())
+                    .where(followers.c.followed_id.in_({post.user_id for post in posts}))
+                    .group_by(followers.c.followed_id)).all())
+                trending.add_posts([(post.id, post.user_id, _unix_time(post.timestamp),
+                                     follower_counts.get(post.user_id, 0)) for post in posts],
+                                   state['epoch'])
+                after = posts[-1].id
+
+            after = 0
+            while True:
+                messages = sharding.execute(shard,
+                    sa.select(Message.id, Message.sender_id, Message.timestamp)
+                    .where(Message.timestamp >= since, Message.id > after)
+                    .order_by(Message.id).limit(batch)).all()
+                if not messages:
+                    break
+                trending.add_author_activity(
+                    [(message.id, message.sender_id, _unix_time(message.timestamp))
+                     for message in messages],
+                    state['epoch'], app.config['TRENDING_MESSAGE_WEIGHT'])
+                after = messages[-1].id
+
+        trending.finish_run(now, state['epoch'])
+
+
+def _unix_time(timestamp):
+    # SQLite hands back naive datetimes; they are all UTC.
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
     
 
+@sharding.sharded
+class ArchivedPost(db.Model):
+    # Posts older than POST_ARCHIVE_AGE, moved here in batches by the archive_posts task, with
+    # their original ids. Listings read this table only once they page past the end of the
+    # (much smaller) post table; see app/archive.py.
+    __tablename__ = 'post_archive'
+    # Still searchable: the documents stay in the post index (see Post._from_ids, Post.reindex).
+    __searchable__ = ['body']
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True, autoincrement=False)
+    body: so.Mapped[str] = so.mapped_column(sa.String(140))
+    timestamp: so.Mapped[datetime] = so.mapped_column(index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('user.id'), index=True)
+    author: so.Mapped[User] = so.relationship(viewonly=True)
+    language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
+
+    def __repr__(self):
+        return '<ArchivedPost {}>'.format(self.body)
+
+    @hybrid_property
+    def shard_user_id(self):
+        return self.user_id
+
+
+@sharding.sharded
 class Message(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     # Mapped[int] is not the "actual type" of the value at runtime — it's a typing placeholder. 
@@ -280,6 +670,9 @@ class Message(db.Model):
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(
         index=True, default=lambda: datetime.now(timezone.utc))
+    conversation_id: so.Mapped[Optional[int]] = so.mapped_column(sa.ForeignKey('conversation.id'))
+    # Conversation history is read newest first by id, a page at a time.
+    __table_args__ = (sa.Index('ix_message_conversation_id_id', 'conversation_id', 'id'),)
     
     author: so.Mapped[User] = so.relationship(
         foreign_keys='Message.sender_id',
@@ -291,6 +684,121 @@ class Message(db.Model):
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
+    @hybrid_property
+    def shard_user_id(self):
+        # The conversation's first user (the smaller id): both sides read it from one shard.
+        sender_id = self.sender_id if self.sender_id is not None else self.author.id
+        recipient_id = self.recipient_id if self.recipient_id is not None else self.recipient.id
+        return min(sender_id, recipient_id)
+
+    @shard_user_id.inplace.expression
+    @classmethod
+    def _shard_user_id_expression(cls):
+        return sa.case((cls.sender_id < cls.recipient_id, cls.sender_id), else_=cls.recipient_id)
+
+
+class Conversation(db.Model):
+    # One row per pair of users, user1_id being the smaller id, plus a Participant row for each
+    # side holding what differs between them (unread count, last read message).
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    user1_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
+    user2_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
+    last_message_id: so.Mapped[Optional[int]]
+    __table_args__ = (sa.UniqueConstraint('user1_id', 'user2_id'),)
+
+    @classmethod
+    def between(cls, user, other, create=False):
+        user1_id, user2_id = sorted((user.id, other.id))
+        query = sa.select(cls).where(cls.user1_id == user1_id, cls.user2_id == user2_id)
+        conversation = db.session.scalar(query)
+        if conversation is None and create:
+            conversation = cls(user1_id=user1_id, user2_id=user2_id)
+            participants = [Participant(conversation=conversation, user_id=user.id,
+                                        other_user_id=other.id)]
+            if other.id != user.id:
+                participants.append(Participant(conversation=conversation, user_id=other.id,
+                                                other_user_id=user.id))
+            try:
+                with db.session.begin_nested():
+                    db.session.add_all(participants)
+            except sa.exc.IntegrityError:
+                # Both users wrote their first message at the same time.
+                conversation = db.session.scalar(query)
+        return conversation
+
+    @classmethod
+    def record(cls, message):
+        '''Attach a new message to its conversation and update both participants in one UPDATE.'''
+        conversation = cls.between(message.author, message.recipient, create=True)
+        message.conversation_id = conversation.id
+        db.session.flush()
+        conversation.last_message_id = message.id
+        db.session.execute(
+            sa.update(Participant)
+            .where(Participant.conversation_id == conversation.id)
+            .values(last_message_id=message.id,
+                    # The sender has obviously read the conversation up to their own message.
+                    unread_count=sa.case(
+                        (Participant.user_id == message.author.id, 0),
+                        else_=Participant.unread_count + 1),
+                    last_read_message_id=sa.case(
+                        (Participant.user_id == message.author.id, message.id),
+                        else_=Participant.last_read_message_id)),
+            execution_options={'synchronize_session': False})
+        return conversation
+
+    def participant(self, user):
+        return db.session.get(Participant, (self.id, user.id))
+
+    def messages(self, before=None, limit=None):
+        '''Messages newest first; keyset pagination on the message id.'''
+        query = sa.select(Message).where(Message.conversation_id == self.id)
+        if before is not None:
+            query = query.where(Message.id < before)
+        return sharding.scalars(sharding.shard_for(self.user1_id),
+                                query.order_by(Message.id.desc()).limit(limit)).all()
+
+
+class Participant(db.Model):
+    conversation_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Conversation.id),
+                                                       primary_key=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), primary_key=True)
+    other_user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
+    last_message_id: so.Mapped[Optional[int]]
+    last_read_message_id: so.Mapped[Optional[int]]
+    unread_count: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    # The inbox: a user's conversations, most recently active first.
+    __table_args__ = (sa.Index('ix_participant_user_id_last_message_id', 'user_id', 'last_message_id'),)
+
+    conversation: so.Mapped[Conversation] = so.relationship()
+    other_user: so.Mapped[User] = so.relationship(foreign_keys=[other_user_id])
+
+    def mark_read(self):
+        self.unread_count = 0
+        self.last_read_message_id = self.last_message_id
+
+    @classmethod
+    def inbox(cls, user, before=None, limit=None):
+        '''
+        (participant, other user, last message) rows, newest conversation first. The last
+        message is None if its shard did not return it; such rows still count towards limit.
+        '''
+        query = (sa.select(cls, User, Conversation.user1_id)
+                 .join(User, User.id == cls.other_user_id)
+                 .join(Conversation, Conversation.id == cls.conversation_id)
+                 .where(cls.user_id == user.id, cls.last_message_id.is_not(None)))
+        if before is not None:
+            query = query.where(cls.last_message_id < before)
+        rows = db.session.execute(query.order_by(cls.last_message_id.desc()).limit(limit)).all()
+        # The last messages are on their conversations' shards: one lookup per shard involved.
+        ids = defaultdict(list)
+        for participant, other, user1_id in rows:
+            ids[sharding.shard_for(user1_id)].append(participant.last_message_id)
+        messages = {message.id: message for shard in ids
+                    for message in sharding.load(Message, ids[shard], [shard])}
+        return [(participant, other, messages.get(participant.last_message_id))
+                for participant, other, user1_id in rows]
+
 
 class Notification(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -299,6 +807,8 @@ class Notification(db.Model):
                                                index=True)
     timestamp: so.Mapped[float] = so.mapped_column(index=True, default=time)
     payload_json: so.Mapped[str] = so.mapped_column(sa.Text)
+    # /notifications reads a user's notifications in timestamp order.
+    __table_args__ = (sa.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),)
 
     user: so.Mapped[User] = so.relationship(back_populates='notifications')
 
@@ -335,7 +845,131 @@ class Task(db.Model):
 
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    data = user_cache.get(int(id))
+    if data is None:
+        user = db.session.get(User, int(id))
+        if user is not None:
+            user_cache.put(user)
+        return user
+    # Rebuild the user from the cached columns and attach it to the session as if it had been
+    # loaded by a query, but without running one (merge with load=False). Columns that are not
+    # in the snapshot, like password_hash, are loaded only if something reads them.
+    user = User(**data)
+    so.make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def _insert_ignoring_duplicates(table):
+    # INSERT ... ON CONFLICT DO NOTHING in whichever dialect the database speaks.
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect in ('mysql', 'mariadb'):
+        return sa.insert(table).prefix_with('IGNORE')
+    return sa.insert(table)
+
+
+# Ids of the sharded tables: the next free id of each table, handed out in blocks, so that ids
+# stay unique when the rows are spread over several databases.
+id_sequence = db.Table('id_sequence',
+                       db.metadata,
+                       sa.Column('name', sa.String(64), primary_key=True),
+                       sa.Column('next_id', sa.BigInteger, nullable=False)
+                       )
+
+
+def next_ids(table, count):
+    '''count new ids for rows of table, unique across all shards.'''
+    # In its own short transaction, so the sequence row is never locked for longer than this.
+    while True:
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                sa.update(id_sequence).where(id_sequence.c.name == table.name)
+                .values(next_id=id_sequence.c.next_id + count)).rowcount
+            if updated:
+                next_id = connection.scalar(sa.select(id_sequence.c.next_id)
+                                            .where(id_sequence.c.name == table.name))
+                return range(next_id - count, next_id)
+        # First use: start after every id there is already, in the main database and on the
+        # shards.
+        query = sa.select(sa.func.max(table.c.id))
+        start = 1 + max([db.session.scalar(query, bind_arguments={'bind': db.engine}) or 0] +
+                        [sharding.execute(shard, query).scalar() or 0
+                         for shard in sharding.shards()])
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(sa.insert(id_sequence).values(name=table.name,
+                                                                 next_id=start + count))
+            return range(start, start + count)
+        except sa.exc.IntegrityError:
+            pass  # somebody else started the sequence in the meantime
+
+
+def _assign_shard_ids(session, flush_context, instances):
+    if not sharding.enabled():
+        return
+    new = defaultdict(list)
+    for obj in session.new:
+        if type(obj) in sharding.SHARDED_MODELS and obj.id is None:
+            new[type(obj).__table__].append(obj)
+    for table, objs in new.items():
+        for obj, id in zip(objs, next_ids(table, len(objs))):
+            obj.id = id
+
+
+def _collect_changed_users(session, flush_context):
+    changed = session.info.setdefault('changed_users', {})
+    renamed = session.info.setdefault('renamed_users', {})
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changed[obj.id] = (obj.username, obj.email)
+            # Registrations and new usernames or avatars, for the typeahead index; a changed
+            # last_seen, the usual reason for a dirty user, is not worth a trip to Redis.
+            state = sa.inspect(obj)
+            if obj not in session.deleted and any(
+                    state.attrs[name].history.has_changes() for name in ('username', 'avatar_hash')):
+                renamed[obj.id] = (obj.username, obj.avatar_hash)
+
+
+def _invalidate_changed_users(session):
+    changed = session.info.pop('changed_users', None) or {}
+    # Users updated with bulk statements, which the flush never sees.
+    stale = session.info.pop('stale_user_ids', set())
+    user_cache.invalidate(list(stale | set(changed)))
+    for username, email in changed.values():
+        availability.add('username', username)
+        availability.add('email', email)
+    for user_id, (username, avatar_hash) in (session.info.pop('renamed_users', None) or {}).items():
+        typeahead.add(user_id, username, avatar_hash)
+
+
+def _forget_changed_users(session):
+    session.info.pop('changed_users', None)
+    session.info.pop('renamed_users', None)
+    session.info.pop('stale_user_ids', None)
+    session.info.pop('pending_events', None)
+
+
+def _forget_after_rollback(session, previous_transaction):
+    # A savepoint rolled back (e.g. Conversation.between() losing a race) leaves the enclosing
+    # transaction, and what it will publish and invalidate when it commits, as it was.
+    if not previous_transaction.nested:
+        _forget_changed_users(session)
+
+
+def _publish_events(session):
+    for user_id, name, data, timestamp in session.info.pop('pending_events', []):
+        delivery.publish(user_id, name, data, timestamp)
+
+db.event.listen(db.session, 'before_flush', _assign_shard_ids)
+db.event.listen(db.session, 'after_flush', _collect_changed_users)
+db.event.listen(db.session, 'after_commit', _invalidate_changed_users)
+db.event.listen(db.session, 'after_commit', _publish_events)
+db.event.listen(db.session, 'after_soft_rollback', _forget_after_rollback)
 
 '''
 Password Hashing:
@@ -0,0 +1,73 @@
+# Password hashing off the request path.
+# scrypt is deliberately slow, so hashing and verification run in a small pool of worker
+# processes instead of the request thread. The number of requests that may wait for the pool is
+# bounded: when it is full, new ones are turned away with a 503 instead of piling up.
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHashingBusy(ServiceUnavailable):
+    description = 'Too many sign-ins are being processed right now, please try again.'
+
+
+_pool = None
+_slots = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool, _slots
+    with _pool_lock:
+        if _pool is None:
+            workers = current_app.config['PASSWORD_HASH_WORKERS']
+            # spawn rather than fork: the web worker has threads, and spawn is all Windows has anyway.
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context('spawn'))
+            _slots = threading.BoundedSemaphore(
+                workers + current_app.config['PASSWORD_HASH_QUEUE'])
+        return _pool, _slots
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def _run(func, *args):
+    if not current_app.config['PASSWORD_HASH_WORKERS']:
+        return func(*args)
+    pool, slots = _get_pool()
+    if not slots.acquire(timeout=current_app.config['PASSWORD_HASH_ADMISSION_TIMEOUT']):
+        raise PasswordHashingBusy(retry_after=1)
+    try:
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool:
+        # A worker died (killed by the OS, for example). Start a new pool next time and
+        # answer this request in-process.
+        _reset_pool()
+        return func(*args)
+    finally:
+        slots.release()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(pwhash, password):
+    return _run(check_password_hash, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    # Stored hashes look like 'scrypt:32768:8:1$<salt>$<hash>'; the part before the first $
+    # is the method and its parameters.
+    return pwhash.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
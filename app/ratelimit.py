@@ -0,0 +1,77 @@
+# Token-bucket rate limiting for the expensive endpoints listed in Config.RATELIMITS.
+# Each request is checked against one bucket per user (when logged in) and one per IP address.
+# All buckets are refilled, checked and charged by a single Lua script, so enforcement costs
+# one round trip to Redis and concurrent requests cannot race each other.
+
+import math
+import redis
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+TOKEN_BUCKET = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local t = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    t = math.min(burst, t + math.max(0, now - ts) * rate)
+    if t < 1 then
+        wait = math.max(wait, (1 - t) / rate)
+    end
+    tokens[i] = t
+end
+
+local ttl = math.ceil(burst / rate) + 1
+for i, key in ipairs(KEYS) do
+    if wait == 0 then
+        tokens[i] = tokens[i] - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', key, ttl)
+end
+
+redis.call('HINCRBY', ARGV[3], ARGV[4] .. (wait == 0 and ':allowed' or ':limited'), 1)
+return tostring(wait)
+'''
+
+METRICS_KEY = 'metrics:ratelimit'
+
+
+def init_app(app):
+    app.ratelimit_script = app.redis.register_script(TOKEN_BUCKET)
+    app.before_request(check_rate_limit)
+
+
+def check_rate_limit():
+    if not current_app.config['RATELIMIT_ENABLED']:
+        return
+    limit = current_app.config['RATELIMITS'].get(request.endpoint)
+    if limit is None or request.method not in limit['methods']:
+        return
+    keys = [f'ratelimit:{request.endpoint}:ip:{request.remote_addr}']
+    if current_user.is_authenticated:
+        keys.append(f'ratelimit:{request.endpoint}:user:{current_user.id}')
+    try:
+        wait = float(current_app.ratelimit_script(
+            keys=keys, args=[limit['rate'], limit['burst'], METRICS_KEY, request.endpoint]))
+    except redis.exceptions.RedisError:
+        # Fail open: an unavailable Redis should not take the site down with it.
+        return
+    if wait > 0:
+        raise TooManyRequests(retry_after=math.ceil(wait))
+
+
+def get_metrics():
+    '''Allowed/limited request counters per endpoint, e.g. {'auth.login': {'allowed': 10, 'limited': 2}}.'''
+    metrics = {}
+    for field, value in current_app.redis.hgetall(METRICS_KEY).items():
+        endpoint, outcome = field.decode().rsplit(':', 1)
+        metrics.setdefault(endpoint, {})[outcome] = int(value)
+    return metrics
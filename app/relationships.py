@@ -0,0 +1,56 @@
+# Follow state between the current user and the users shown on a page.
+# Views that list users call prefetch() once with all of them; templates then ask for
+# relationship(user) per row, which is answered from a per-request cache in g. A user that was
+# not prefetched is looked up on its own, so templates never have to care.
+
+from collections import namedtuple
+import sqlalchemy as sa
+from flask import g
+from flask_login import current_user
+from app import db
+from app.models import followers
+
+Relationship = namedtuple('Relationship', ['following', 'followed_by'])
+NO_RELATIONSHIP = Relationship(False, False)
+
+
+def _cache():
+    if '_relationships' not in g:
+        g._relationships = {}
+    return g._relationships
+
+
+def prefetch(users):
+    '''Load the follow state in both directions for users (or user ids) in one query.'''
+    if not current_user.is_authenticated:
+        return
+    cache = _cache()
+    ids = {getattr(user, 'id', user) for user in users} - set(cache) - {current_user.id}
+    if not ids:
+        return
+    me = current_user.id
+    rows = db.session.execute(sa.select(followers.c.follower_id, followers.c.followed_id).where(
+        sa.or_(sa.and_(followers.c.follower_id == me, followers.c.followed_id.in_(ids)),
+               sa.and_(followers.c.followed_id == me, followers.c.follower_id.in_(ids)))))
+    following, followed_by = set(), set()
+    for follower_id, followed_id in rows:
+        if follower_id == me:
+            following.add(followed_id)
+        else:
+            followed_by.add(follower_id)
+    for id in ids:
+        cache[id] = Relationship(id in following, id in followed_by)
+
+
+def relationship(user):
+    '''Relationship(following, followed_by) of the current user towards user.'''
+    if not current_user.is_authenticated or user.id == current_user.id:
+        return NO_RELATIONSHIP
+    cache = _cache()
+    if user.id not in cache:
+        prefetch([user])
+    return cache[user.id]
+
+
+def init_app(app):
+    app.add_template_global(relationship)
@@ -0,0 +1,48 @@
+# A small periodic scheduler on top of the task queues.
+#
+# SCHEDULE maps task names to the number of seconds between runs. `flask scheduler run` wakes
+# up every SCHEDULER_TICK seconds and, for each entry, tries to create a Redis key that expires
+# after the entry's interval: while the key exists the task is not due, and when the SET NX
+# succeeds the task is enqueued. The key is the whole schedule state, so any number of
+# schedulers can run side by side (or be restarted) without a task ever running twice per
+# interval.
+
+import time
+import redis
+from flask import current_app
+from app import workers
+
+
+def _key(task_name):
+    return f'schedule:{task_name}'
+
+
+def run_due(now=None):
+    '''Enqueue every scheduled task that is due; returns their names.'''
+    now = now or time.time()
+    enqueued = []
+    for task_name, interval in current_app.config['SCHEDULE'].items():
+        if current_app.redis.set(_key(task_name), int(now), nx=True, ex=int(interval)):
+            workers.enqueue(task_name)
+            enqueued.append(task_name)
+    return enqueued
+
+
+def run_forever():
+    while True:
+        try:
+            for task_name in run_due():
+                current_app.logger.info('scheduler: enqueued %s', task_name)
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning('scheduler: %s', e)
+        time.sleep(current_app.config['SCHEDULER_TICK'])
+
+
+def status():
+    '''(task name, interval, seconds until the next run) for every scheduled task.'''
+    pipe = current_app.redis.pipeline(transaction=False)
+    schedule = current_app.config['SCHEDULE']
+    for task_name in schedule:
+        pipe.ttl(_key(task_name))
+    return [(task_name, interval, max(ttl, 0))
+            for (task_name, interval), ttl in zip(schedule.items(), pipe.execute())]
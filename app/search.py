@@ -2,7 +2,10 @@
 # keeping the rest of the app decoupled from direct ES access. 
 # If we ever switch to another engine, we only need to update this module—no changes needed elsewhere.
 
+import asyncio
 from flask import current_app
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import bulk
 
 def add_to_index(index, model):
     if not current_app.elasticsearch:
@@ -13,6 +16,23 @@ def add_to_index(index, model):
 
     current_app.elasticsearch.index(index=index, id=model.id, document=payload)
 
+def add_to_index_bulk(index, models):
+    '''Index any number of models with bulk requests; returns how many were indexed.'''
+    if not current_app.elasticsearch:
+        return 0
+    actions = ({'_index': index, '_id': model.id,
+                '_source': {field: getattr(model, field) for field in model.__searchable__}}
+               for model in models)
+    indexed, errors = bulk(current_app.elasticsearch, actions, chunk_size=500)
+    return indexed
+
+def remove_from_index_bulk(index, ids):
+    '''Remove any number of documents by id with bulk requests; missing ones are ignored.'''
+    if not current_app.elasticsearch:
+        return
+    actions = ({'_op_type': 'delete', '_index': index, '_id': id} for id in ids)
+    bulk(current_app.elasticsearch, actions, chunk_size=500, raise_on_error=False)
+
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
@@ -29,3 +49,19 @@ def query_index(index, query, page, per_page):
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
 
+
+async def query_index_async(index, query, page, per_page):
+    if not current_app.elasticsearch:
+        return [], 0
+    # Async views run each request on a fresh event loop, so the async client cannot be shared
+    # the way app.elasticsearch is; it is opened for the request and closed when the search is done.
+    async with AsyncElasticsearch([current_app.config['ELASTICSEARCH_URL']],
+                                  node_class='httpxasync',
+                                  request_timeout=current_app.config['SEARCH_TIMEOUT']) as es:
+        search = await asyncio.wait_for(es.search(
+            index=index,
+            query={'multi_match': {'query': query, 'fields': ['*']}},
+            from_=(page - 1) * per_page,
+            size=per_page), timeout=current_app.config['SEARCH_TIMEOUT'])
+    ids = [int(hit['_id']) for hit in search['hits']['hits']]
+    return ids, search['hits']['total']['value']
@@ -0,0 +1,284 @@
+# Posts and messages spread over several databases by user id.
+#
+# The databases are Flask-SQLAlchemy binds listed in SHARDS; a user's posts (live and archived)
+# live on shard_for(user id), and so do the messages of every conversation whose first user
+# (the smaller id) it is, so a profile page or a conversation reads a single shard. Everything
+# else (users, followers, conversations, notifications, ...) stays in the main database. With
+# SHARDS empty there is a single "shard", None, which is the main database itself.
+#
+# ShardedSession, the class of db.session, routes the rows of the models marked with @sharded:
+# new rows go to the shard of their shard_user_id, rows that were loaded are written back and
+# refreshed from the shard they came from (it is their SQLAlchemy identity token), and queries
+# name their shard with execute()/scalars(). A query for a sharded model that names no shard
+# raises ShardingError instead of silently reading the main database.
+#
+# Listings that cover many users (explore, the home timeline) are a scatter-gather: every
+# shard is asked, in parallel, for the (timestamp, id) keys of its first rows, the sorted
+# answers are merged with heapq.merge, and only the rows that made it into the page are loaded.
+# Ids are unique across shards (see next_ids() in app/models.py) and therefore say nothing about
+# where a row lives, so moving rows between shards (rebalance(), `flask shards rebalance`) keeps
+# them valid everywhere else: search index, trending list, conversations.
+
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import sqlalchemy as sa
+from flask import current_app
+from flask_sqlalchemy.session import Session
+
+SHARDED_MODELS = []
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ShardingError(RuntimeError):
+    pass
+
+
+def sharded(model):
+    '''Class decorator for models whose rows are placed by their shard_user_id.'''
+    SHARDED_MODELS.append(model)
+    return model
+
+
+def _is_sharded(mapper=None, clause=None):
+    table = mapper.local_table if mapper is not None else getattr(clause, 'table', None)
+    return any(model.__table__ is table for model in SHARDED_MODELS)
+
+
+def _db():
+    # app/__init__.py imports this module to create db, so db cannot be imported here.
+    return current_app.extensions['sqlalchemy']
+
+
+def enabled():
+    return bool(current_app.config['SHARDS'])
+
+
+def shards():
+    return list(current_app.config['SHARDS']) or [None]
+
+
+def shard_for(user_id):
+    keys = shards()
+    return keys[user_id % len(keys)]
+
+
+def shard_for_row(model, values):
+    '''The shard of a row of model given as a dict of its column values.'''
+    return shard_for(model.__dict__['shard_user_id'].fget(SimpleNamespace(**values)))
+
+
+def shards_for(user_ids):
+    '''The shards holding the rows of user_ids, in SHARDS order.'''
+    wanted = {shard_for(user_id) for user_id in user_ids}
+    return [shard for shard in shards() if shard in wanted]
+
+
+def engine(shard):
+    return _db().engines[shard]
+
+
+class ShardedSession(Session):
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self._sharded = enabled()
+        if self._sharded:
+            # Only installed with shards configured: SQLAlchemy's bulk operations refuse to work
+            # with a per-instance connection_callable.
+            self.connection_callable = self._connection_for_instance
+            sa.event.listen(self, 'do_orm_execute', _route)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, shard=None, **kwargs):
+        if bind is None and shard is not None:
+            return self._db.engines[shard]
+        if bind is None and self._sharded and _is_sharded(mapper, clause):
+            raise ShardingError(f'{(mapper or clause).__class__.__name__} for a sharded table '
+                                'was executed without a shard')
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _connection_for_instance(self, mapper, instance):
+        # Called by the unit of work for every row it writes.
+        if not _is_sharded(mapper):
+            return self.connection(bind_arguments={'mapper': mapper})
+        state = sa.inspect(instance)
+        shard = state.key[2] if state.key else state.identity_token
+        if shard is None:
+            shard = state.identity_token = shard_for(instance.shard_user_id)
+        return self.connection(bind_arguments={'shard': shard})
+
+
+def _route(orm_context):
+    # ORM statements for sharded models: take the shard from the bind arguments, or, for the
+    # refresh of an expired row and other loads on behalf of an instance, from its identity
+    # token; the token is handed on to the rows that are loaded.
+    if not _is_sharded(orm_context.bind_mapper):
+        return None
+    shard = orm_context.bind_arguments.get('shard')
+    if shard is None:
+        if orm_context.is_select:
+            options = orm_context.load_options
+        elif orm_context.is_update or orm_context.is_delete:
+            options = orm_context.update_delete_options
+        else:
+            return None
+        shard = options._identity_token
+        if shard is None:
+            return None
+    orm_context.update_execution_options(identity_token=shard)
+    return orm_context.invoke_statement(
+        bind_arguments={**orm_context.bind_arguments, 'shard': shard})
+
+
+def execute(shard, statement, *args):
+    return _db().session.execute(statement, *args, bind_arguments={'shard': shard})
+
+
+def scalars(shard, statement):
+    return _db().session.scalars(statement, bind_arguments={'shard': shard})
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=current_app.config['SHARD_QUERY_THREADS'],
+                                       thread_name_prefix='shard-query')
+        return _pool
+
+
+def _fetch(engine, statement):
+    with engine.connect() as connection:
+        return connection.execute(statement).all()
+
+
+def _scatter(statement, keys):
+    '''statement's rows from every shard in keys, one list per shard, read in parallel.'''
+    if len(keys) == 1:
+        return [execute(keys[0], statement).all()]
+    engines = [engine(shard) for shard in keys]
+    return list(_get_pool().map(_fetch, engines, itertools.repeat(statement)))
+
+
+def gather(statement, keys, offset, limit):
+    '''
+    (shard, row) pairs offset to offset + limit of statement run over the shards in keys.
+    statement must select timestamp and id columns and be ordered by them, newest first; the
+    answers of the shards are merged in that order.
+    '''
+    statement = statement.limit(offset + limit)
+    results = _scatter(statement, keys)
+    merged = heapq.merge(*[[(shard, row) for row in rows] for shard, rows in zip(keys, results)],
+                         key=lambda item: (item[1].timestamp, item[1].id), reverse=True)
+    return list(itertools.islice(merged, offset, offset + limit))
+
+
+def count(statement, keys):
+    counted = sa.select(sa.func.count()).select_from(statement.order_by(None).subquery())
+    return sum(rows[0][0] for rows in _scatter(counted, keys))
+
+
+def load(model, ids, keys=None):
+    '''The rows of model with the given ids found on the shards in keys (all by default).'''
+    rows = []
+    for shard in keys or shards():
+        rows += scalars(shard, sa.select(model).where(model.id.in_(ids)))
+    return rows
+
+
+def select_page(statement, model, keys, offset, limit):
+    '''
+    Rows offset to offset + limit of statement, a select of model ordered by timestamp and id,
+    newest first, over the shards in keys.
+    '''
+    if len(keys) == 1:
+        return scalars(keys[0], statement.offset(offset).limit(limit)).all()
+    found = gather(statement.with_only_columns(model.id, model.timestamp), keys, offset, limit)
+    by_shard = defaultdict(list)
+    for shard, row in found:
+        by_shard[shard].append(row.id)
+    rank = {row.id: i for i, (shard, row) in enumerate(found)}
+    rows = []
+    for shard, ids in by_shard.items():
+        rows += load(model, ids, [shard])
+    return sorted(rows, key=lambda row: rank[row.id])
+
+
+def _shard_metadata():
+    # The sharded tables without their foreign keys: the tables they point to stay in the
+    # main database. Ids are handed out by next_ids(), never by the shard.
+    metadata = sa.MetaData()
+    for model in SHARDED_MODELS:
+        table = model.__table__
+        copy = sa.Table(table.name, metadata, *[
+            sa.Column(column.name, column.type, primary_key=column.primary_key,
+                      nullable=column.nullable, autoincrement=False)
+            for column in table.columns])
+        for index in table.indexes:
+            sa.Index(index.name, *[copy.c[column.name] for column in index.columns],
+                     unique=index.unique)
+    return metadata
+
+
+def create_all():
+    metadata = _shard_metadata()
+    for shard in current_app.config['SHARDS']:
+        metadata.create_all(engine(shard))
+
+
+def drop_all():
+    metadata = _shard_metadata()
+    for shard in current_app.config['SHARDS']:
+        metadata.drop_all(engine(shard))
+
+
+def rebalance(chunk_size):
+    '''
+    Move every row that is not on the shard it belongs to (after shards were added to SHARDS,
+    for example), including rows still in the main database from before sharding was turned
+    on. Rows are copied in chunks, committed, and only then deleted from where they were, so
+    an interrupted run leaves duplicates at worst, which the next run cleans up. Returns the
+    number of rows moved per table.
+    '''
+    if not enabled():
+        raise ShardingError('SHARDS is empty: there is nothing to rebalance')
+    session = _db().session
+    keys = shards()
+    moved = {}
+    for model in SHARDED_MODELS:
+        table = model.__table__
+        moved[table.name] = 0
+        shard_user_id = model.shard_user_id
+        # The main database first, with its tables from before sharding, then every shard.
+        sources = [({'bind': _db().engine}, sa.true())] + [
+            ({'shard': shard}, shard_user_id % len(keys) != i) for i, shard in enumerate(keys)]
+        for bind_arguments, misplaced in sources:
+            last_id = 0
+            while True:
+                rows = session.execute(
+                    sa.select(table, shard_user_id.label('shard_user_id')).where(table.c.id > last_id, misplaced)
+                    .order_by(table.c.id).limit(chunk_size),
+                    bind_arguments=bind_arguments).all()
+                if not rows:
+                    break
+                by_shard = defaultdict(list)
+                for row in rows:
+                    values = row._asdict()
+                    by_shard[shard_for(values.pop('shard_user_id'))].append(values)
+                for shard, values in by_shard.items():
+                    ids = [value['id'] for value in values]
+                    # Left over from an interrupted run, if anything.
+                    execute(shard, sa.delete(table).where(table.c.id.in_(ids)))
+                    execute(shard, sa.insert(table), values)
+                session.commit()
+                ids = [row.id for row in rows]
+                session.execute(sa.delete(table).where(table.c.id.in_(ids)),
+                                bind_arguments=bind_arguments)
+                session.commit()
+                moved[table.name] += len(rows)
+                last_id = rows[-1].id
+    return moved
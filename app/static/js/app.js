@@ -0,0 +1,246 @@
+// Page behaviour shared by every template. This used to be an inline block in base.html;
+// values that came from Jinja are now read from data attributes on <body>.
+
+async function translate(sourceElem, destElem, sourceLang, destLang) {
+  document.getElementById(destElem).innerHTML = '<img src="' + document.body.dataset.loadingUrl + '">';
+  const response = await fetch('/translate', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json; charset=utf-8' },
+    body: JSON.stringify({
+      text: document.getElementById(sourceElem).innerText,
+      source_language: sourceLang,
+      dest_language: destLang
+    })
+  })
+  const data = await response.json();
+  document.getElementById(destElem).innerText = data.text;
+}
+
+function initialize_popovers() {
+  const popups = document.getElementsByClassName('user_popup');
+
+  for (let i = 0; i < popups.length; i++) {
+    const el = popups[i]
+    const popover = new bootstrap.Popover(el, {
+      content: 'Loading...',
+      trigger: 'hover focus',
+      placement: 'right',
+      html: true,
+      sanitize: false,
+      delay: { show: 500, hide: 0 },
+      container: el,
+      customClass: 'd-inline',
+    });
+
+    el.addEventListener('show.bs.popover', async (ev) => {
+      if (ev.target.popupLoaded) {
+        return;
+      }
+
+      const response = await fetch('/user/' + ev.target.innerText.trim() + '/popup');
+      const data = await response.text();
+      const popover = bootstrap.Popover.getInstance(ev.target);
+      if (popover && data) {
+        ev.target.popupLoaded = true;
+        popover.setContent({ '.popover-body': data });
+        flask_moment_render_all();
+      }
+
+    });
+
+    el.addEventListener('shown.bs.popover', () => {
+      // Always rerun moment rendering in case of dynamic content like timestamps
+      flask_moment_render_all();
+    });
+
+  }
+}
+document.addEventListener('DOMContentLoaded', initialize_popovers);
+
+function set_message_count(n) {
+  const count = document.getElementById('message_count');
+  count.innerText = n;
+  count.style.visibility = n ? 'visible' : 'hidden';
+}
+
+function set_task_progress(task_id, progress) {
+  const progressElement = document.getElementById(task_id + '-progress');
+  if (progressElement) {
+    progressElement.innerText = progress;
+  }
+}
+
+function handle_notification(name, data) {
+  switch (name) {
+    case 'unread_message_count':
+      set_message_count(data);
+      break;
+    case 'task_progress':
+      set_task_progress(data.task_id, data.progress);
+      break;
+  }
+}
+
+function initialize_notifications() {
+  // Only rendered for logged in users.
+  const url = document.body.dataset.notificationsUrl;
+  if (!url) {
+    return;
+  }
+  let since = 0;
+  let timer = null;
+
+  async function poll() {
+    let query = '?since=' + since;
+    while (query) {
+      const response = await fetch(url + query);
+      const page = await response.json();
+      for (const notification of page.notifications) {
+        handle_notification(notification.name, notification.data);
+        since = notification.timestamp;
+      }
+      // A long absence can leave more than one page to catch up on.
+      query = page.next ? '?cursor=' + page.next : null;
+    }
+  }
+
+  function start_polling() {
+    if (!timer) {
+      timer = setInterval(poll, 6000);
+    }
+  }
+
+  const eventsUrl = document.body.dataset.eventsUrl;
+  if (!window.EventSource || !eventsUrl) {
+    start_polling();
+    return;
+  }
+  // Events are pushed as they happen; the browser reconnects by itself and resumes from the
+  // last event it received. If the stream cannot be opened at all, fall back to polling.
+  const source = new EventSource(eventsUrl);
+  for (const name of ['unread_message_count', 'task_progress']) {
+    source.addEventListener(name, (ev) => handle_notification(name, JSON.parse(ev.data)));
+  }
+  source.addEventListener('reset', poll);  // events were missed while we were away
+  source.addEventListener('error', () => {
+    if (source.readyState === EventSource.CLOSED) {
+      start_polling();
+    }
+  });
+}
+document.addEventListener('DOMContentLoaded', initialize_notifications);
+
+function initialize_availability() {
+  // Tells the user whether a username is free while they type in the registration form.
+  // Emails are only checked when the form is submitted, so they cannot be enumerated.
+  const form = document.getElementById('registration');
+  if (!form) {
+    return;
+  }
+  const input = form.querySelector('#username');
+  let timer = null;
+  input.addEventListener('input', () => {
+    clearTimeout(timer);
+    timer = setTimeout(async () => {
+      const value = input.value.trim();
+      input.classList.remove('is-valid', 'is-invalid');
+      if (!value) {
+        return;
+      }
+      const response = await fetch('/auth/availability?' + new URLSearchParams({ username: value }));
+      if (!response.ok) {
+        return;
+      }
+      const data = await response.json();
+      if (data.value !== input.value.trim()) {
+        return;  // the user kept typing
+      }
+      let feedback = input.parentElement.querySelector('.invalid-feedback');
+      if (!feedback) {
+        feedback = document.createElement('div');
+        feedback.className = 'invalid-feedback';
+        input.after(feedback);
+      }
+      feedback.innerText = 'Please use a different username.';
+      input.classList.add(data.available ? 'is-valid' : 'is-invalid');
+    }, 300);
+  });
+}
+document.addEventListener('DOMContentLoaded', initialize_availability);
+
+function initialize_typeahead() {
+  // Suggests usernames, most followed first, in the search box and after an @ in the post form.
+  const url = document.body.dataset.typeaheadUrl;
+  if (!url) {
+    return;
+  }
+  const attach = (input, prefixAt, choose) => {
+    const menu = document.createElement('ul');
+    menu.className = 'dropdown-menu';
+    input.parentElement.style.position = 'relative';
+    input.after(menu);
+    let timer = null;
+    const hide = () => menu.classList.remove('show');
+    input.addEventListener('input', () => {
+      clearTimeout(timer);
+      timer = setTimeout(async () => {
+        const prefix = prefixAt();
+        if (!prefix) {
+          hide();
+          return;
+        }
+        const response = await fetch(url + '?' + new URLSearchParams({ q: prefix }));
+        if (!response.ok || prefixAt() !== prefix) {
+          return;  // the user kept typing
+        }
+        const data = await response.json();
+        menu.replaceChildren(...data.users.map(user => {
+          const item = document.createElement('li');
+          const link = document.createElement('a');
+          link.className = 'dropdown-item';
+          link.href = '#';
+          const avatar = document.createElement('img');
+          avatar.src = user.avatar;
+          avatar.className = 'me-2';
+          link.append(avatar, user.username);
+          link.addEventListener('mousedown', event => {
+            event.preventDefault();  // keep the focus in the input
+            hide();
+            choose(user.username);
+          });
+          item.append(link);
+          return item;
+        }));
+        menu.classList.toggle('show', data.users.length > 0);
+      }, 100);
+    });
+    input.addEventListener('blur', hide);
+    input.addEventListener('keydown', event => {
+      if (event.key === 'Escape') {
+        hide();
+      }
+    });
+  };
+
+  const search = document.getElementById('q');
+  if (search) {
+    attach(search, () => search.value.trim().replace(/^@/, ''),
+      username => { window.location = document.body.dataset.userUrl + encodeURIComponent(username); });
+  }
+  const post = document.getElementById('post');
+  if (post) {
+    // The word being typed, if it is a mention: "@" and what follows it up to the caret.
+    const mention = () => {
+      const match = post.value.slice(0, post.selectionStart).match(/(?:^|\s)@(\w+)$/);
+      return match ? match[1] : '';
+    };
+    attach(post, mention, username => {
+      const caret = post.selectionStart;
+      const start = caret - mention().length;
+      post.value = post.value.slice(0, start) + username + ' ' + post.value.slice(caret);
+      post.selectionStart = post.selectionEnd = start + username.length + 1;
+      post.focus();
+    });
+  }
+}
+document.addEventListener('DOMContentLoaded', initialize_typeahead);
@@ -0,0 +1,104 @@
+# "Who to follow" suggestions, computed offline from the follower graph and kept in Redis.
+#
+# The followers table is loaded once into a sparse CSR matrix F, where F[i, j] = 1 if user i
+# follows user j (users are renumbered 0..n-1 so the matrix has no empty rows for deleted ids).
+# Two scores are then computed for a batch of users at a time:
+#     F[batch] @ F    friends of friends: how many of the people I follow also follow k
+#     F.T[batch] @ F  common followers: how many of my followers also follow k
+# Only the rows for one batch of users are ever materialised, so memory is bounded by the edge
+# arrays plus SUGGESTIONS_BATCH_SIZE rows of results. Like app/search.py, this module knows
+# nothing about the models; User.update_suggestions() feeds it the edges.
+
+import numpy as np
+import redis
+import scipy.sparse as sp
+from flask import current_app
+
+
+def _key(user_id):
+    return f'suggestions:{user_id}'
+
+
+def load_graph(edge_count, chunks):
+    '''
+    Build the follow matrix from chunks of (follower_id, followed_id) rows. Returns the matrix and
+    the sorted array of user ids; row/column i of the matrix belongs to user ids[i].
+    '''
+    # int32 keeps an edge at 8 bytes; the arrays are filled in place, never grown.
+    follower = np.empty(edge_count, dtype=np.int32)
+    followed = np.empty(edge_count, dtype=np.int32)
+    n = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.int32).reshape(-1, 2)[:edge_count - n]
+        follower[n:n + len(chunk)] = chunk[:, 0]
+        followed[n:n + len(chunk)] = chunk[:, 1]
+        n += len(chunk)
+    follower, followed = follower[:n], followed[:n]
+
+    ids = np.unique(np.concatenate([follower, followed]))
+    rows = np.searchsorted(ids, follower)
+    cols = np.searchsorted(ids, followed)
+    data = np.ones(n, dtype=np.float32)
+    graph = sp.csr_matrix((data, (rows, cols)), shape=(len(ids), len(ids)))
+    return graph, ids
+
+
+def compute(graph, ids):
+    '''Yield (user_id, [suggested user ids, best first]) for every user in the graph.'''
+    config = current_app.config
+    count = config['SUGGESTIONS_COUNT']
+    weight = np.float32(config['SUGGESTIONS_COMMON_FOLLOWER_WEIGHT'])
+    batch_size = config['SUGGESTIONS_BATCH_SIZE']
+    followed_by = graph.T.tocsr()
+
+    for start in range(0, graph.shape[0], batch_size):
+        stop = min(start + batch_size, graph.shape[0])
+        following = graph[start:stop]
+        scores = following @ graph + weight * (followed_by[start:stop] @ graph)
+        # Drop users that are already followed, and each user's own column.
+        scores = scores - scores.multiply(following)
+        own = sp.csr_matrix((np.ones(stop - start, dtype=np.float32),
+                             (np.arange(stop - start), np.arange(start, stop))),
+                            shape=scores.shape)
+        scores = scores - scores.multiply(own)
+        scores.eliminate_zeros()
+
+        for row in range(stop - start):
+            begin, end = scores.indptr[row], scores.indptr[row + 1]
+            if begin == end:
+                yield ids[start + row], []
+                continue
+            values = scores.data[begin:end]
+            columns = scores.indices[begin:end]
+            if len(values) > count:
+                top = np.argpartition(-values, count)[:count]
+                values, columns = values[top], columns[top]
+            # Highest score first, ties broken by lowest id so the result is stable.
+            order = np.lexsort((columns, -values))
+            yield ids[start + row], ids[columns[order]].tolist()
+
+
+def store(suggestions):
+    '''Write the output of compute() to Redis, one short string per user.'''
+    ttl = current_app.config['SUGGESTIONS_TTL']
+    pipe = current_app.redis.pipeline(transaction=False)
+    written = 0
+    for user_id, suggested in suggestions:
+        if suggested:
+            pipe.set(_key(user_id), ','.join(str(id) for id in suggested), ex=ttl)
+        else:
+            pipe.delete(_key(user_id))
+        written += 1
+        if written % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+    return written
+
+
+def get(user_id):
+    '''Suggested user ids for user_id, best first; empty if there are none or Redis is down.'''
+    try:
+        value = current_app.redis.get(_key(user_id))
+    except redis.exceptions.RedisError:
+        return []
+    return [int(id) for id in value.split(b',')] if value else []
@@ -1,11 +1,15 @@
+import itertools
 import json
 import sys
 import time
+from datetime import datetime, timedelta, timezone
 import sqlalchemy as sa
 from flask import render_template
 from rq import get_current_job
-from app import create_app, db
-from app.models import User, Post, Task
+from rq.registry import StartedJobRegistry
+from rq.worker_registration import clean_worker_registry
+from app import create_app, db, archive, sharding
+from app.models import User, Post, ArchivedPost, Task, Notification
 from app.email import send_email
 
 app = create_app()
@@ -25,6 +29,128 @@ def example(seconds):
     print('Task completed')
 
 
+def rebuild_availability():
+    try:
+        counts = User.rebuild_availability()
+        app.logger.info('Rebuilt availability filters: %s', counts)
+    finally:
+        app.redis.delete('bloom:user:rebuilding')
+
+
+def rebuild_typeahead():
+    try:
+        count = User.rebuild_typeahead()
+        app.logger.info('Rebuilt the typeahead index: %d users', count)
+    finally:
+        app.redis.delete('typeahead:rebuilding')
+
+
+def update_trending():
+    Post.update_trending()
+
+
+def update_suggestions():
+    User.update_suggestions()
+
+
+# Maintenance jobs, run by the scheduler (see SCHEDULE in config.py). Each one returns, and
+# logs, what it removed and how long it took; RQ keeps the return value as the job result.
+
+def _report(name, start, **counts):
+    report = dict(counts, seconds=round(time.monotonic() - start, 3))
+    app.logger.info('maintenance %s: %s', name, report)
+    return report
+
+
+def _delete_in_chunks(model, condition):
+    # Short transactions, so the deletes never hold locks for long.
+    removed = 0
+    while True:
+        ids = db.session.scalars(sa.select(model.id).where(condition)
+                                 .limit(app.config['MAINTENANCE_CHUNK_SIZE'])).all()
+        if not ids:
+            return removed
+        db.session.execute(sa.delete(model).where(model.id.in_(ids)))
+        db.session.commit()
+        removed += len(ids)
+
+
+def prune_notifications():
+    start = time.monotonic()
+    cutoff = time.time() - app.config['NOTIFICATION_RETENTION']
+    removed = _delete_in_chunks(Notification, Notification.timestamp < cutoff)
+    return _report('prune_notifications', start, removed=removed)
+
+
+def prune_tasks():
+    start = time.monotonic()
+    removed = _delete_in_chunks(Task, Task.complete == True)
+    return _report('prune_tasks', start, removed=removed)
+
+
+def clean_job_registries():
+    # Drops expired entries from the finished/failed/deferred registries, moves jobs whose
+    # worker died from the started registry to the failed one (or back to the queue if they
+    # have retries left), and drops registrations of workers that died without cleaning up.
+    # Each registry is cleaned and counted on its own, in the order rq's clean_registries()
+    # uses: the failed registry's count would otherwise hide the jobs moved into it.
+    start = time.monotonic()
+    removed = abandoned = 0
+    for queue in app.task_queues.values():
+        for registry in [queue.finished_job_registry, queue.started_job_registry,
+                         queue.failed_job_registry, queue.deferred_job_registry]:
+            # registry.count cleans the registry up before counting, so it cannot be used here.
+            before = registry.get_job_count(cleanup=False)
+            registry.cleanup()
+            cleaned = before - registry.get_job_count(cleanup=False)
+            if isinstance(registry, StartedJobRegistry):
+                abandoned += cleaned
+            else:
+                removed += cleaned
+        clean_worker_registry(queue)
+    return _report('clean_job_registries', start, removed=removed, abandoned=abandoned)
+
+
+def archive_posts():
+    start = time.monotonic()
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=app.config['POST_ARCHIVE_AGE'])
+    moved = archive.archive_posts(cutoff, app.config['MAINTENANCE_CHUNK_SIZE'])
+    return _report('archive_posts', start, removed=moved)
+
+
+def analyze_database():
+    # Fresh planner statistics; on SQLite also give back the space of deleted rows once a
+    # good part of the file is free pages. The main database and every shard.
+    start = time.monotonic()
+    databases = [(db.engine, list(db.metadata.tables))]
+    if sharding.enabled():
+        tables = [model.__table__.name for model in sharding.SHARDED_MODELS]
+        databases += [(sharding.engine(shard), tables) for shard in sharding.shards()]
+    vacuumed = sum(_analyze(engine, tables) for engine, tables in databases)
+    return _report('analyze_database', start, removed=0, vacuumed=vacuumed)
+
+
+def _analyze(engine, tables):
+    # True if the database was vacuumed.
+    vacuumed = False
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        dialect = conn.dialect.name
+        if dialect == 'sqlite':
+            free = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+            pages = conn.exec_driver_sql('PRAGMA page_count').scalar()
+            if pages and free / pages > app.config['SQLITE_VACUUM_FREE_RATIO']:
+                conn.exec_driver_sql('VACUUM')
+                vacuumed = True
+            conn.exec_driver_sql('ANALYZE')
+        elif dialect == 'postgresql':
+            # Dead rows are reclaimed by autovacuum; make sure the statistics are current.
+            conn.exec_driver_sql('ANALYZE')
+        elif dialect in ('mysql', 'mariadb'):
+            conn.exec_driver_sql(f'ANALYZE TABLE {", ".join(f"`{table}`" for table in tables)}')
+    return vacuumed
+
+
 def _set_task_progress(progress):
     job = get_current_job()
     if job:
@@ -44,10 +170,16 @@ def export_posts(user_id):
         _set_task_progress(0)
         data = []
         i = 0
-        total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(
-            user.posts.select().subquery()))
-        for post in db.session.scalars(user.posts.select().order_by(
-                Post.timestamp.asc())):
+        shard = sharding.shard_for(user.id)
+        total_posts = sum(sharding.count(user.own_posts(model), [shard])
+                          for model in (Post, ArchivedPost))
+        # Oldest first: the archived posts, then the ones still in the post table.
+        posts = itertools.chain(
+            sharding.scalars(shard, user.own_posts(ArchivedPost).order_by(None)
+                             .order_by(ArchivedPost.timestamp.asc())),
+            sharding.scalars(shard, user.own_posts(Post).order_by(None)
+                             .order_by(Post.timestamp.asc())))
+        for post in posts:
             data.append({'body': post.body,
                          'timestamp': post.timestamp.isoformat() + 'Z'})
             time.sleep(5)
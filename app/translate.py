@@ -1,30 +1,75 @@
+import asyncio
 import requests
+import httpx
 from flask_babel import _
 from flask import current_app as app
 
 # Read Documentation: https://learn.microsoft.com/en-us/azure/ai-services/translator/text-translation/reference/v3/translate
-def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in app.config or \
-            not app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
+ENDPOINT = 'https://api.cognitive.microsofttranslator.com/translate'
+
+
+def _is_configured():
+    return 'MS_TRANSLATOR_KEY' in app.config and app.config['MS_TRANSLATOR_KEY']
+
+
+def _request_args(source_language, dest_language):
     auth = {
         'Ocp-Apim-Subscription-Key': app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': 'southeastasia',
     }
-
-    endpoint = "https://api.cognitive.microsofttranslator.com"
-    path='/translate'
-    constructed_url = endpoint+path
     params = {
     'api-version': '3.0',
     'from': source_language,
     'to': dest_language
     }
+    return params, auth
+
+
+def translate(text, source_language, dest_language):
+    if not _is_configured():
+        return _('Error: the translation service is not configured.')
+    params, auth = _request_args(source_language, dest_language)
 
-    # request = requests.post(constructed_url, params=params, headers=headers, json=body)
-    r = requests.post(constructed_url, params=params, headers=auth, json=[{'Text': text}])
+    r = requests.post(ENDPOINT, params=params, headers=auth, json=[{'Text': text}],
+                      timeout=app.config['TRANSLATOR_TIMEOUT'])
 
     # r is the response object
     if r.status_code != 200:
         return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+    return r.json()[0]['translations'][0]['text']
+
+
+async def _translate_chunk(client, texts, source_language, dest_language):
+    # The translator accepts a list of texts in one call, so a chunk costs a single round trip.
+    params, auth = _request_args(source_language, dest_language)
+    try:
+        r = await asyncio.wait_for(
+            client.post(ENDPOINT, params=params, headers=auth,
+                        json=[{'Text': text} for text in texts]),
+            timeout=app.config['TRANSLATOR_TIMEOUT'])
+    except (asyncio.TimeoutError, httpx.HTTPError):
+        return [_('Error: the translation service failed.')] * len(texts)
+    if r.status_code != 200:
+        return [_('Error: the translation service failed.')] * len(texts)
+    return [item['translations'][0]['text'] for item in r.json()]
+
+
+async def translate_batch(texts, source_language, dest_language):
+    '''
+    Translate a list of texts, splitting it into chunks of TRANSLATOR_BATCH_SIZE that are
+    sent concurrently. The result keeps the order of the input.
+    '''
+    if not _is_configured():
+        return [_('Error: the translation service is not configured.')] * len(texts)
+    size = app.config['TRANSLATOR_BATCH_SIZE']
+    chunks = [texts[i:i + size] for i in range(0, len(texts), size)]
+    # The client is created per call because async views get a fresh event loop for every request.
+    async with httpx.AsyncClient() as client:
+        results = await asyncio.gather(*[
+            _translate_chunk(client, chunk, source_language, dest_language)
+            for chunk in chunks])
+    return [text for chunk in results for text in chunk]
+
+
+async def translate_async(text, source_language, dest_language):
+    return (await translate_batch([text], source_language, dest_language))[0]
@@ -0,0 +1,112 @@
+# Trending posts and hot authors, precomputed into Redis sorted sets by the update_trending task.
+#
+# Scores decay with time without ever being rewritten: a post's score is
+#     log2(1 + author followers) + timestamp / half_life
+# so a post that is one half-life newer counts twice as much. Comparing two scores gives the same
+# order as decaying both to "now", which means each run only has to score the posts created since
+# the previous one. Authors accumulate 2 ** ((timestamp - epoch) / half_life) for every post and
+# message they write; the epoch follows the clock in whole half-lives to keep those numbers small.
+#
+# "Created since the previous run" goes by timestamp, not by id, and reaches TRENDING_OVERLAP
+# seconds further back: a row gets its timestamp and id before its transaction commits, so a
+# run can miss rows that commit just after it even though their ids are lower than ones it saw.
+# Rows scanned twice are recognised by their id (POST_TIMES, MESSAGE_TIMES) and only counted
+# towards their author once.
+
+import math
+from flask import current_app
+
+POSTS = 'trending:posts'
+POST_TIMES = 'trending:posts:time'
+AUTHORS = 'trending:authors'
+MESSAGE_TIMES = 'trending:messages:time'
+STATE = 'trending:state'
+
+
+def get_state(now):
+    state = current_app.redis.hgetall(STATE)
+    return {
+        'last_run': float(state.get(b'last_run', 0)),
+        'epoch': float(state.get(b'epoch', 0)) or now,
+    }
+
+
+def _half_life():
+    return current_app.config['TRENDING_HALF_LIFE']
+
+
+def _new(key, items):
+    # The (id, unix timestamp) items that key did not have yet; adds them.
+    pipe = current_app.redis.pipeline()
+    for item_id, timestamp in items:
+        pipe.zadd(key, {item_id: timestamp}, nx=True)
+    return [item for item, added in zip(items, pipe.execute()) if added]
+
+
+def add_posts(posts, epoch):
+    '''posts: (post_id, author_id, unix timestamp, author follower count) tuples.'''
+    new = set(_new(POST_TIMES, [(post_id, timestamp) for post_id, _, timestamp, _ in posts]))
+    pipe = current_app.redis.pipeline()
+    for post_id, author_id, timestamp, follower_count in posts:
+        # Scored again if seen again: the follower count may have changed.
+        pipe.zadd(POSTS, {post_id: math.log2(1 + follower_count) + timestamp / _half_life()})
+        if (post_id, timestamp) in new:
+            pipe.zincrby(AUTHORS, 2 ** ((timestamp - epoch) / _half_life()), author_id)
+    pipe.execute()
+
+
+def add_author_activity(activity, epoch, weight):
+    '''activity: (message id, author_id, unix timestamp) tuples, one per message sent.'''
+    new = set(_new(MESSAGE_TIMES, [(message_id, timestamp) for message_id, _, timestamp in activity]))
+    pipe = current_app.redis.pipeline()
+    for message_id, author_id, timestamp in activity:
+        if (message_id, timestamp) in new:
+            pipe.zincrby(AUTHORS, weight * 2 ** ((timestamp - epoch) / _half_life()), author_id)
+    pipe.execute()
+
+
+def finish_run(now, epoch):
+    '''Drop posts that left the window, rebase the author scores if needed and save the state.'''
+    pipe = current_app.redis.pipeline()
+    # Messages are only remembered for as long as a run can scan them again.
+    pipe.zremrangebyscore(MESSAGE_TIMES, '-inf', now - 2 * current_app.config['TRENDING_OVERLAP'])
+    expired = current_app.redis.zrangebyscore(
+        POST_TIMES, '-inf', now - current_app.config['TRENDING_WINDOW'])
+    if expired:
+        pipe.zrem(POSTS, *expired)
+        pipe.zrem(POST_TIMES, *expired)
+    # Author scores are at most TRENDING_MAX_AUTHORS entries, so rescaling them to a recent
+    # epoch on every run is cheap. Once rebased, an author whose activity decayed below 1e-6
+    # of a post written now can be dropped.
+    halvings = math.floor((now - epoch) / _half_life())
+    if halvings > 0:
+        pipe.zunionstore(AUTHORS, {AUTHORS: 2.0 ** -halvings})
+        epoch += halvings * _half_life()
+    pipe.zremrangebyscore(AUTHORS, '-inf', 1e-6)
+    pipe.zremrangebyrank(AUTHORS, 0, -current_app.config['TRENDING_MAX_AUTHORS'] - 1)
+    pipe.hset(STATE, mapping={'last_run': now, 'epoch': epoch})
+    pipe.hdel(STATE, 'last_post_id', 'last_message_id')  # the id cursors of earlier versions
+    pipe.hincrby(STATE, 'version', 1)
+    pipe.execute()
+
+
+def reset():
+    '''Forget everything, e.g. after an import: the next run scores the whole window again.'''
+    current_app.redis.delete(POSTS, POST_TIMES, MESSAGE_TIMES, AUTHORS, STATE)
+
+
+def get_posts(page, per_page):
+    '''Post ids for one page of the trending list, and the total number of trending posts.'''
+    pipe = current_app.redis.pipeline()
+    pipe.zrevrange(POSTS, (page - 1) * per_page, page * per_page - 1)
+    pipe.zcard(POSTS)
+    ids, total = pipe.execute()
+    return [int(id) for id in ids], total
+
+
+def get_authors(count):
+    return [int(id) for id in current_app.redis.zrevrange(AUTHORS, 0, count - 1)]
+
+
+def get_version():
+    return int(current_app.redis.hget(STATE, 'version') or 0)
@@ -0,0 +1,181 @@
+# Username completion for the search box and @mentions, served from a prefix index in Redis.
+#
+# Every lowercased prefix of a username, up to TYPEAHEAD_MAX_PREFIX characters, has a sorted set
+# of user ids scored by follower count, trimmed to its TYPEAHEAD_PER_PREFIX best ranked users;
+# a hash holds what a suggestion shows (username, avatar hash, follower count). A lookup is one
+# ZREVRANGE and one HMGET, run together by a Lua script so it costs a single round trip.
+#
+# The index is built by rebuild() under a new generation number and the generation pointer is
+# switched when it is complete, so readers never see a half-built index. Registrations and
+# username changes are added to the current generation with add(); follower counts are only
+# refreshed by the next rebuild (see SCHEDULE in config.py). While a rebuild runs, add() also
+# writes to the generation being built and records the user id, and the rebuild reads those
+# users again once its bulk load is done, so a change made in the meantime is not overwritten
+# by the stale copy the bulk read returned nor lost with the old generation. Like
+# app/availability.py, this module knows nothing about the models.
+
+import json
+import redis
+from flask import current_app
+from app import workers
+
+GENERATION = 'typeahead:generation'
+BUILDING = 'typeahead:building'
+
+LOOKUP = '''
+local generation = redis.call('GET', KEYS[1])
+if not generation then
+    return false
+end
+local prefix = 'typeahead:' .. generation .. ':'
+local ids = redis.call('ZREVRANGE', prefix .. 'p:' .. ARGV[1], 0, tonumber(ARGV[2]) - 1)
+if #ids == 0 then
+    return {}
+end
+return redis.call('HMGET', prefix .. 'users', unpack(ids))
+'''
+
+
+def _prefix_key(generation, prefix):
+    return f'typeahead:{generation}:p:{prefix}'
+
+
+def _users_key(generation):
+    return f'typeahead:{generation}:users'
+
+
+def _changed_key(generation):
+    return f'typeahead:{generation}:changed'
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _prefixes(username):
+    username = username.lower()
+    longest = min(len(username), current_app.config['TYPEAHEAD_MAX_PREFIX'])
+    return [username[:n] for n in range(1, longest + 1)]
+
+
+def _trim(pipe, key):
+    pipe.zremrangebyrank(key, 0, -current_app.config['TYPEAHEAD_PER_PREFIX'] - 1)
+
+
+def lookup(prefix, limit):
+    '''
+    Up to limit (username, avatar hash) pairs for users whose name starts with prefix, most
+    followed first. None if the index cannot answer: not built yet, Redis is down, or the
+    prefix is longer than the indexed ones.
+    '''
+    prefix = prefix.lower()
+    if not prefix or len(prefix) > current_app.config['TYPEAHEAD_MAX_PREFIX']:
+        return None
+    try:
+        entries = current_app.redis.eval(LOOKUP, 1, GENERATION, prefix, limit)
+        if entries is None:
+            if current_app.config['TYPEAHEAD_AUTO_REBUILD']:
+                _request_rebuild()
+            return None
+    except redis.exceptions.RedisError:
+        return None
+    return [tuple(json.loads(entry)[:2]) for entry in entries if entry is not None]
+
+
+def add(user_id, username, avatar_hash, followers=None):
+    '''
+    Add or update a user in the current index, and in the one being built if a rebuild is
+    running; followers=None keeps the count the index has. Does nothing if there is neither:
+    the rebuild that creates the index reads the user table.
+    '''
+    try:
+        r = current_app.redis
+        current, building = (_decode(value) for value in r.mget(GENERATION, BUILDING))
+        if building is not None:
+            r.sadd(_changed_key(building), user_id)
+        for generation in {current, building} - {None}:
+            _apply(r, generation, user_id, username, avatar_hash, followers)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _apply(r, generation, user_id, username, avatar_hash, followers):
+    old = r.hget(_users_key(generation), user_id)
+    old_prefixes = []
+    if old is not None:
+        old_username, _, old_followers = json.loads(old)
+        old_prefixes = _prefixes(old_username)
+        if followers is None:
+            followers = old_followers
+    prefixes = _prefixes(username)
+    pipe = r.pipeline(transaction=False)
+    for prefix in set(old_prefixes) - set(prefixes):
+        pipe.zrem(_prefix_key(generation, prefix), user_id)
+    for prefix in prefixes:
+        pipe.zadd(_prefix_key(generation, prefix), {user_id: followers or 0})
+        _trim(pipe, _prefix_key(generation, prefix))
+    pipe.hset(_users_key(generation), user_id, json.dumps([username, avatar_hash, followers or 0]))
+    pipe.execute()
+
+
+def rebuild(read_users, read_changed):
+    '''
+    Build a new index and switch to it, then drop the previous one. read_users() returns an
+    iterable of (id, username, avatar hash, follower count) for every user; it is called once
+    add() has started recording changes for the new index. read_changed(ids) returns the same
+    for the given ids, the users changed while the index was being built, and must see what
+    has been committed since read_users() was called. Returns the number of users indexed.
+    '''
+    r = current_app.redis
+    generation = r.incr('typeahead:generations')
+    # A rebuild that dies leaves the marker behind; it goes away on its own.
+    r.set(BUILDING, generation, ex=3600)
+    pipe = r.pipeline(transaction=False)
+    touched = set()
+    count = 0
+    for user_id, username, avatar_hash, followers in read_users():
+        for prefix in _prefixes(username):
+            pipe.zadd(_prefix_key(generation, prefix), {user_id: followers})
+            touched.add(prefix)
+        pipe.hset(_users_key(generation), user_id, json.dumps([username, avatar_hash, followers]))
+        count += 1
+        if count % 1000 == 0:
+            # Trimming as we go keeps the short, crowded prefixes ("a", "j", ...) small.
+            for prefix in touched:
+                _trim(pipe, _prefix_key(generation, prefix))
+            touched.clear()
+            pipe.execute()
+    for prefix in touched:
+        _trim(pipe, _prefix_key(generation, prefix))
+    pipe.execute()
+    # The bulk read may predate some of these changes and have overwritten them. Changes made
+    # from here on go to the new generation through add() directly.
+    changed = [int(user_id) for user_id in r.smembers(_changed_key(generation))]
+    if changed:
+        for user_id, username, avatar_hash, followers in read_changed(changed):
+            _apply(r, generation, user_id, username, avatar_hash, followers)
+    pipe.delete(_changed_key(generation))
+    pipe.set(GENERATION, generation, get=True)
+    pipe.delete(BUILDING)
+    _, previous, _ = pipe.execute()
+    if previous is not None:
+        _drop(_decode(previous))
+    return count
+
+
+def _drop(generation):
+    r = current_app.redis
+    batch = []
+    for key in r.scan_iter(match=f'typeahead:{generation}:*', count=1000):
+        batch.append(key)
+        if len(batch) == 1000:
+            r.unlink(*batch)
+            batch = []
+    if batch:
+        r.unlink(*batch)
+
+
+def _request_rebuild():
+    # At most one rebuild job at a time, however many requests notice the index is missing.
+    if current_app.redis.set('typeahead:rebuilding', 1, nx=True, ex=600):
+        workers.enqueue('rebuild_typeahead')
@@ -0,0 +1,98 @@
+# Cache for the user loader.
+# Flask-Login loads the current user on every authenticated request. Instead of a SELECT each time,
+# load_user() asks this module for a snapshot of the user's columns: first from a small per-process
+# LRU with a short TTL, then from Redis. The snapshot carries User.version, so anything derived from
+# it (the ETags in app/conditional.py) changes together with it.
+
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from time import monotonic
+import redis
+from flask import current_app
+
+COLUMNS = ('id', 'username', 'email', 'avatar_hash', 'about_me', 'last_seen',
+           'last_message_read_time', 'version')
+DATETIME_COLUMNS = ('last_seen', 'last_message_read_time')
+
+_lock = threading.Lock()
+
+
+def _local():
+    # Kept per application, so apps created by the tests do not see each other's users.
+    return current_app.extensions.setdefault('user_cache', OrderedDict())
+
+
+def _key(user_id):
+    return f'user-snapshot:{user_id}'
+
+
+def snapshot(user):
+    data = {column: getattr(user, column) for column in COLUMNS}
+    for column in DATETIME_COLUMNS:
+        if data[column] is not None:
+            data[column] = data[column].isoformat()
+    return data
+
+
+def _restore(data):
+    for column in DATETIME_COLUMNS:
+        if data[column] is not None:
+            data[column] = datetime.fromisoformat(data[column])
+    return data
+
+
+def get(user_id):
+    '''Return the cached column values of a user as a dict, or None if not cached.'''
+    local = _local()
+    with _lock:
+        entry = local.get(user_id)
+        if entry is not None:
+            expires, data = entry
+            if expires > monotonic():
+                local.move_to_end(user_id)
+                return _restore(dict(data))
+            del local[user_id]
+    try:
+        raw = current_app.redis.get(_key(user_id))
+    except redis.exceptions.RedisError:
+        return None
+    if raw is None:
+        return None
+    data = json.loads(raw)
+    _put_local(user_id, data)
+    return _restore(dict(data))
+
+
+def put(user):
+    data = snapshot(user)
+    _put_local(user.id, data)
+    try:
+        current_app.redis.set(_key(user.id), json.dumps(data),
+                              ex=current_app.config['USER_CACHE_TTL'])
+    except redis.exceptions.RedisError:
+        pass
+
+
+def _put_local(user_id, data):
+    local = _local()
+    with _lock:
+        local[user_id] = (monotonic() + current_app.config['USER_CACHE_LOCAL_TTL'], data)
+        local.move_to_end(user_id)
+        while len(local) > current_app.config['USER_CACHE_SIZE']:
+            local.popitem(last=False)
+
+
+def invalidate(user_ids):
+    # Other processes drop their local copy when its (short) TTL runs out.
+    if not user_ids:
+        return
+    local = _local()
+    with _lock:
+        for user_id in user_ids:
+            local.pop(user_id, None)
+    try:
+        current_app.redis.delete(*[_key(user_id) for user_id in user_ids])
+    except redis.exceptions.RedisError:
+        pass
@@ -0,0 +1,91 @@
+# Background task queues and the warm worker pool that consumes them.
+#
+# Tasks are routed to one of the queues in TASK_QUEUES by name (TASK_ROUTES), so a long
+# export_posts run in the bulk queue never delays the short jobs in the interactive one.
+# `flask workers start` imports app.tasks, which builds the application, once, then forks
+# TASK_QUEUES[name] workers per queue. The workers are RQ SimpleWorkers: they run every job in
+# their own already initialised process instead of forking a fresh work horse per job.
+
+import logging
+import os
+import signal
+import time
+from flask import current_app
+from rq import SimpleWorker
+
+logger = logging.getLogger(__name__)
+
+
+def queue_for(task_name):
+    routes = current_app.config['TASK_ROUTES']
+    return current_app.task_queues[routes.get(task_name, current_app.config['TASK_DEFAULT_QUEUE'])]
+
+
+def enqueue(task_name, *args, **kwargs):
+    return queue_for(task_name).enqueue(f'app.tasks.{task_name}', *args, **kwargs)
+
+
+def _work(app, queue_name):
+    # Runs in a forked child. Connections must not be shared with the parent: the SQLAlchemy
+    # pools (the main database's and every shard's) are told to forget the inherited ones, and
+    # redis-py notices the new pid by itself.
+    from app import db
+    for engine in db.engines.values():
+        engine.dispose(close=False)
+    worker = SimpleWorker([app.task_queues[queue_name]], connection=app.redis)
+    worker.work(with_scheduler=True)
+
+
+def run_pool(app, pools):
+    '''Fork the workers in pools ({queue name: count}) and keep them running until stopped.'''
+    children = {}
+    stopping = False
+
+    def spawn(queue_name):
+        pid = os.fork()
+        if pid == 0:
+            # A process group of its own, so Ctrl-C in the terminal only reaches the parent:
+            # RQ installs its own SIGINT handler, and a Ctrl-C followed by the parent's SIGTERM
+            # would be two signals to it, which it takes as a cold shutdown that kills the job.
+            os.setpgrp()
+            # The parent's handlers were inherited; back to the defaults until RQ installs its own.
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                _work(app, queue_name)
+            except BaseException:
+                logger.exception('worker for %s failed', queue_name)
+                os._exit(1)
+            os._exit(0)
+        children[pid] = queue_name
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                # RQ finishes the current job, then exits; a second stop (Ctrl-C again) makes it
+                # a cold shutdown, as with a single RQ worker.
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for queue_name, count in pools.items():
+        for _ in range(count):
+            spawn(queue_name)
+    logger.info('worker pool started: %s', pools)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        queue_name = children.pop(pid, None)
+        if queue_name is not None and not stopping:
+            logger.warning('worker %d for %s exited with status %d, restarting',
+                           pid, queue_name, status)
+            time.sleep(1)
+            if not stopping:
+                spawn(queue_name)
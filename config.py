@@ -29,19 +29,159 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db') # class variable
     
+    # Databases that posts and messages are spread over by user id, as Flask-SQLAlchemy binds
+    # (see app/sharding.py). Without any, they stay in the main database.
+    SHARD_URLS = os.environ.get('SHARD_URLS', '').split()
+    SQLALCHEMY_BINDS = {f'shard{i}': url for i, url in enumerate(SHARD_URLS)}
+    SHARDS = list(SQLALCHEMY_BINDS) # bind keys; a user's rows go to SHARDS[user id % len(SHARDS)]
+    SHARD_QUERY_THREADS = 8 # per process, for the parallel reads of a scatter-gather
+    SHARD_REBALANCE_CHUNK = 1000 # rows per copy/delete round in flask shards rebalance
+    
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    ERROR_MAIL_DEDUP_WINDOW = 600 # the same error is mailed at most once per this many seconds
+    ERROR_MAIL_MAX_PER_HOUR = 10 # error mails per hour, all errors together
     ADMINS = ['siddghosh8953@gmail.com']
 
     POSTS_PER_PAGE = 2
+    USERS_PER_PAGE = 25 # followers/following lists
+    FOLLOW_LIST_CACHE_TTL = 300 # first page of a followers/following list, when it is full
 
     LANGUAGES = ['en', 'es', 'de', 'hi']
 
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
+    TRANSLATOR_BATCH_SIZE = 25 # texts per call; larger batches are split and sent concurrently
 
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_TIMEOUT = float(os.environ.get('SEARCH_TIMEOUT') or 5)
+
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # RQ queues, highest priority first, and how many workers `flask workers start` runs for each.
+    TASK_QUEUES = {
+        'interactive': int(os.environ.get('INTERACTIVE_WORKERS') or 2),
+        'bulk': int(os.environ.get('BULK_WORKERS') or 1),
+        'maintenance': int(os.environ.get('MAINTENANCE_WORKERS') or 1),
+    }
+    TASK_DEFAULT_QUEUE = 'interactive'
+    TASK_ROUTES = { # task name -> queue; anything not listed goes to TASK_DEFAULT_QUEUE
+        'export_posts': 'bulk',
+        'rebuild_availability': 'maintenance',
+        'rebuild_typeahead': 'maintenance',
+        'update_trending': 'maintenance',
+        'update_suggestions': 'maintenance',
+        'prune_notifications': 'maintenance',
+        'prune_tasks': 'maintenance',
+        'clean_job_registries': 'maintenance',
+        'archive_posts': 'maintenance',
+        'analyze_database': 'maintenance',
+    }
+    # Periodic tasks run by `flask scheduler run`: task name -> seconds between runs.
+    SCHEDULE = {
+        'update_trending': 300,
+        'update_suggestions': 24 * 3600,
+        'prune_notifications': 3600,
+        'prune_tasks': 3600,
+        'clean_job_registries': 900,
+        'archive_posts': 24 * 3600,
+        'analyze_database': 24 * 3600,
+        'rebuild_typeahead': 24 * 3600, # refreshes the follower counts the suggestions are ranked by
+    }
+    SCHEDULER_TICK = 10 # seconds between checks for due tasks
+    NOTIFICATION_RETENTION = 30 * 24 * 3600 # notifications older than this are deleted
+    POST_ARCHIVE_AGE = 90 * 24 * 3600 # posts older than this move to the post_archive table
+    MAINTENANCE_CHUNK_SIZE = 1000 # rows per delete transaction
+    SQLITE_VACUUM_FREE_RATIO = 0.25 # VACUUM once this much of the database file is free pages
+
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    # Give the method with all its parameters (e.g. 'pbkdf2:sha256:600000'): users whose stored
+    # hash was made with anything else get rehashed the next time they log in.
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 1)
+    # 0 hashes in the request thread instead of the process pool
+    PASSWORD_HASH_QUEUE = 16 # requests allowed to wait for a busy pool
+    PASSWORD_HASH_ADMISSION_TIMEOUT = 2 # seconds to wait for a place in that queue
+
+    AVAILABILITY_BLOOM_BITS = 2 ** 24 # 2 MB per filter, ~1% false positives at 1.7M users
+    AVAILABILITY_BLOOM_HASHES = 7
+    AVAILABILITY_AUTO_REBUILD = True # queue a rebuild when a filter is missing
+
+    TYPEAHEAD_MAX_PREFIX = 15 # longest username prefix indexed; longer ones are looked up in SQL
+    TYPEAHEAD_PER_PREFIX = 20 # most followed users kept per prefix
+    TYPEAHEAD_RESULTS = 8 # suggestions returned by /typeahead/users
+    TYPEAHEAD_AUTO_REBUILD = True # queue a rebuild when the index is missing
+
+    TRENDING_WINDOW = 7 * 24 * 3600 # posts older than this drop out of the trending list
+    TRENDING_HALF_LIFE = 6 * 3600 # a post this much newer is worth twice as much
+    TRENDING_MESSAGE_WEIGHT = 0.25 # weight of a sent message relative to a post for hot authors
+    TRENDING_MAX_AUTHORS = 1000
+    TRENDING_AUTHORS_SHOWN = 5 # hot authors listed next to the trending posts
+    TRENDING_BATCH_SIZE = 1000
+    TRENDING_OVERLAP = 300 # each run rescans this much before the previous one, for rows committed late
+
+    SUGGESTIONS_COUNT = 20 # suggestions stored per user
+    SUGGESTIONS_SHOWN = 5
+    SUGGESTIONS_COMMON_FOLLOWER_WEIGHT = 0.5 # relative to a friend-of-friend path
+    SUGGESTIONS_BATCH_SIZE = 1000 # users scored per sparse matrix product
+    SUGGESTIONS_TTL = 7 * 24 * 3600
+
+    NOTIFICATIONS_LIMIT = 100 # notifications returned by one /notifications request
+    NOTIFICATIONS_HWM_TTL = 60 # seconds /notifications trusts a user's high-water mark in Redis
+    # /events holds a worker for as long as the stream is open (EVENTS_CONNECTION_SECONDS), so
+    # only turn it on when the server runs async workers (e.g. gunicorn -k gevent); with sync
+    # workers every open page would take one. Pages poll /notifications when it is off.
+    EVENTS_ENABLED = os.environ.get('EVENTS_ENABLED') is not None
+    EVENTS_STREAM_MAXLEN = 1000 # events kept per user stream (approximately)
+    EVENTS_STREAM_TTL = 7 * 24 * 3600 # a stream without new events is deleted after this long
+    EVENTS_BATCH = 100 # stream entries read per XREAD
+    EVENTS_BLOCK_MS = 15000 # how long an XREAD waits before sending a keep-alive
+    EVENTS_CONNECTION_SECONDS = 300 # an /events response is closed after this and the browser reconnects
+    EVENTS_RETRY_MS = 3000
+
+    USER_CACHE_TTL = 300 # seconds a user snapshot stays in Redis
+    USER_CACHE_LOCAL_TTL = 5 # seconds a snapshot stays in each process
+    USER_CACHE_SIZE = 1024 # snapshots kept per process
+    LAST_SEEN_RESOLUTION = 60 # seconds between last_seen updates
+
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or os.path.join(basedir, 'avatars')
+    AVATAR_SIZES = (24, 36, 64, 128, 256) # the sizes the templates use; others are a 404
+    AVATAR_MAX_AGE = 365 * 24 * 3600
+
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_DISABLED') is None
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+    # Reverse proxies in front of the app. With 0, request.remote_addr is the proxy's address and
+    # every client would share its per-IP buckets; with N, X-Forwarded-For/-Proto/-Host as set by
+    # the N proxies are trusted (werkzeug's ProxyFix). Never set it higher than the real count,
+    # or clients can pick their own address.
+    # endpoint -> HTTP methods that are limited, tokens refilled per second and bucket size.
+    # Every client gets one bucket per endpoint for its IP address, and one for its user when logged in.
+    RATELIMITS = {
+        'main.translate_text': {'methods': ['POST'], 'rate': 0.5, 'burst': 20},
+        'main.search': {'methods': ['GET'], 'rate': 1, 'burst': 10},
+        'main.index': {'methods': ['POST'], 'rate': 0.2, 'burst': 5},
+        'main.send_message': {'methods': ['POST'], 'rate': 0.2, 'burst': 5},
+        'auth.login': {'methods': ['POST'], 'rate': 0.1, 'burst': 5},
+        'auth.availability': {'methods': ['GET'], 'rate': 2, 'burst': 20},
+        'main.avatar': {'methods': ['GET'], 'rate': 20, 'burst': 200},
+        'main.username_typeahead': {'methods': ['GET'], 'rate': 5, 'burst': 30},
+        'main.follow_many': {'methods': ['POST', 'DELETE'], 'rate': 0.1, 'burst': 5},
+    }
+    FOLLOW_BULK_MAX = 500 # usernames accepted by one /following request
+    FOLLOW_IMPORT_CHUNK = 1000 # CSV rows per transaction in flask follows import
+    TAG_LINK_CHUNK = 1000 # posts per transaction in flask tags link
+    LOADTEST_USERS = 50 # users flask loadtest seeds and logs in as
+    LOADTEST_POSTS_PER_USER = 5
+    LOADTEST_FOLLOWS_PER_USER = 10
+    DATA_BATCH_SIZE = 5000 # rows per fetch and per INSERT executemany in flask data export/import
+    DATA_TRANSACTION_ROWS = 100000 # rows per transaction in flask data import
+
+    LOG_FILE = 'logs/microblog.log' # JSON lines, written by a background thread
+    LOG_FILE_MAX_BYTES = 10 * 1024 * 1024 # rotate at this size
+    LOG_FILE_BACKUPS = 10
+    LOG_QUEUE_SIZE = 10000 # records waiting to be written; more are dropped, not waited for
 
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    COMPRESS_MIN_SIZE = 1024 # HTML responses smaller than this are sent uncompressed
+    COMPRESS_LEVEL = 6
+    ASSET_PRUNE_AGE = 24 * 3600 # bundles of earlier builds are deleted this long after they were last used
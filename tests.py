@@ -1,13 +1,21 @@
 from datetime import datetime, timezone, timedelta
+import logging.handlers
+import queue
+import tempfile
 import unittest
+from unittest import mock
 from app import create_app, db
-from app.models import User, Post
+from app.models import User, Post, Message, Conversation, Participant, post_tags, mentions
+from app import archive, dataset, loadtest, logqueue, relationships, sharding, suggestions
+import sqlalchemy as sa
+from flask_login import login_user
 
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    PASSWORD_HASH_WORKERS = 0
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -26,11 +34,25 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
     
+    def test_password_rehash(self):
+        u = User(username='susan', email='susan@example.com')
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u.set_password('cat')
+        self.assertFalse(u.password_needs_rehash())
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertTrue(u.password_needs_rehash())
+        self.assertTrue(u.check_password('cat'))
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertFalse(u.password_needs_rehash())
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
-        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
-                                         'd4c74594d841139328695756648b6bd6'
-                                         '?d=identicon&s=128'))
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), ('/avatar/'
+                                             'd4c74594d841139328695756648b6bd6'
+                                             '/128'))
     
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -60,6 +82,170 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_follow_many(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        ids = User.ids_for_usernames(['susan', 'mary', 'john', 'nobody'])
+        self.assertEqual(set(ids), {'john', 'susan', 'mary'})
+        self.assertEqual(u1.follow_many(ids.values()), {u3.id})
+        db.session.commit()
+        self.assertTrue(u1.is_following(u3))
+        self.assertFalse(u1.is_following(u1))
+        self.assertEqual(u3.followers_count(), 1)
+        self.assertEqual(u1.unfollow_many([u2.id, u3.id]), {u2.id, u3.id})
+        db.session.commit()
+        self.assertEqual(u1.following_count(), 0)
+
+    def test_relationships(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        u3.follow(u1)
+        db.session.commit()
+        with self.app.test_request_context():
+            login_user(u1)
+            relationships.prefetch([u1, u2, u3])
+            self.assertEqual(relationships.relationship(u2), (True, False))
+            self.assertEqual(relationships.relationship(u3), (False, True))
+            self.assertEqual(relationships.relationship(u1), (False, False))
+
+    def test_conversations(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        for author, recipient in [(u1, u2), (u1, u2), (u2, u1)]:
+            msg = Message(author=author, recipient=recipient, body='hi')
+            db.session.add(msg)
+            Conversation.record(msg)
+        db.session.commit()
+
+        conversation = Conversation.between(u2, u1)
+        self.assertEqual(conversation.user1_id, u1.id)
+        self.assertEqual(len(conversation.messages()), 3)
+        self.assertEqual(conversation.participant(u1).unread_count, 1)
+        self.assertEqual(conversation.participant(u2).unread_count, 0)
+        [(participant, other, last)] = Participant.inbox(u1)
+        self.assertEqual((other, last), (u2, msg))
+        participant.mark_read()
+        db.session.commit()
+        self.assertEqual(conversation.participant(u1).last_read_message_id, msg.id)
+
+    def test_savepoint_rollback_keeps_pending_events(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 1)
+        db.session.begin_nested().rollback()
+        self.assertEqual(len(db.session.info['pending_events']), 1)
+        db.session.rollback()
+        self.assertNotIn('pending_events', db.session.info)
+
+    def test_notifications_limit(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        for i in range(3):
+            u.add_notification(f'n{i}', i)
+            db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        for limit in (0, -5):
+            response = client.get(f'/notifications?since=0&limit={limit}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json['notifications']), 1)
+            self.assertIsNotNone(response.json['next'])
+
+    def test_loadtest_cleanup(self):
+        real = User(username='loadtest7', email='someone@example.org')
+        db.session.add(real)
+        db.session.commit()
+        usernames = loadtest.seed(3, 2, 2)
+        self.assertEqual(usernames, ['loadtest0', 'loadtest1', 'loadtest2'])
+        self.assertEqual(loadtest.cleanup(2), 3)
+        self.assertEqual(db.session.scalars(sa.select(User.username)).all(), ['loadtest7'])
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Post)), 0)
+
+    def test_archive(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u, timestamp=now - timedelta(days=i))
+                 for i in reversed(range(5))]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        moved = archive.archive_posts(now - timedelta(days=1, hours=12), chunk_size=2)
+        self.assertEqual(moved, 3)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Post)), 2)
+        pages = [archive.paginate(u.own_posts, page, 2) for page in (1, 2, 3)]
+        self.assertEqual([[p.body for p in page.items] for page in pages],
+                         [['post 0', 'post 1'], ['post 2', 'post 3'], ['post 4']])
+        self.assertEqual([page.has_next for page in pages], [True, True, False])
+        self.assertEqual([p.body for p in archive.paginate(u.following_posts, 1, 3).items],
+                         ['post 0', 'post 1', 'post 2'])
+
+    def test_tags_and_mentions(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'#Flask post {i}', author=u1, timestamp=now - timedelta(hours=i))
+                 for i in range(3)]
+        posts.append(Post(body='hi @susan, mail me@example.com #x#y', author=u1, timestamp=now))
+        db.session.add_all(posts)
+        db.session.flush()
+        self.assertEqual(Post.extract_links(posts[3].body), (['x'], ['susan']))
+        Post.link(posts)
+        db.session.commit()
+
+        first = Post.linked(post_tags, post_tags.c.tag, 'flask', None, 2)
+        self.assertEqual([p.body for p in first], ['#Flask post 0', '#Flask post 1'])
+        rest = Post.linked(post_tags, post_tags.c.tag, 'flask', first[-1].id, 2)
+        self.assertEqual([p.body for p in rest], ['#Flask post 2'])
+        self.assertEqual([p.id for p in Post.linked(mentions, mentions.c.user_id, u2.id, None, 5)],
+                         [posts[3].id])
+        self.assertEqual([n.get_data() for n in db.session.scalars(u2.notifications.select())],
+                         [{'post_id': posts[3].id, 'author': 'john'}])
+        # Linking again, as flask tags link does, changes nothing.
+        self.assertEqual(Post.link_existing(chunk_size=3), 4)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(post_tags)), 4)
+
+    def test_data_export_import(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.add(Post(body='hello', author=u2))
+        msg = Message(author=u1, recipient=u2, body='hi')
+        db.session.add(msg)
+        Conversation.record(msg)
+        db.session.commit()
+        sent = msg.timestamp
+
+        with tempfile.TemporaryDirectory() as directory:
+            exported = {name: count for name, count, seconds in dataset.export(directory, 1)}
+            self.assertEqual(exported['user'], 2)
+            with self.assertRaises(dataset.DatasetError):
+                list(dataset.import_(directory, 1, 2))  # not an empty database
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            imported = {name: count for name, count, seconds in dataset.import_(directory, 1, 2)}
+        self.assertEqual(imported, exported)
+        john = db.session.scalar(sa.select(User).where(User.username == 'john'))
+        self.assertEqual([p.body for p in db.session.scalars(john.following_posts())], ['hello'])
+        self.assertEqual(db.session.scalar(sa.select(Message)).timestamp, sent)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -98,6 +284,135 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_suggestions(self):
+        # john follows susan, susan follows mary and david, mary follows david,
+        # ann follows john and mary.
+        edges = [(1, 2), (2, 3), (2, 4), (3, 4), (5, 1), (5, 3)]
+        graph, ids = suggestions.load_graph(len(edges), [edges[:4], edges[4:]])
+        result = dict(suggestions.compute(graph, ids))
+        self.assertEqual(result[1], [3, 4])  # friends of friends, plus ann also follows mary
+        self.assertEqual(result[2], [])  # already follows everyone followed by her circle
+        self.assertEqual(result[3], [1])  # her follower ann also follows john
+        self.assertEqual(result[4], [3])  # his follower susan also follows mary
+
+
+class ShardingCase(unittest.TestCase):
+    # Three SQLite files as shards, and a fourth one to rebalance onto.
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        binds = {f'shard{i}': f'sqlite:///{self.tmp.name}/shard{i}.db' for i in range(4)}
+
+        class ShardedConfig(TestConfig):
+            SQLALCHEMY_BINDS = binds
+            SHARDS = ['shard0', 'shard1', 'shard2']
+
+        self.app = create_app(ShardedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.config['SHARDS'] = list(binds)
+        sharding.create_all()
+        self.app.config['SHARDS'] = ShardedConfig.SHARDS
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def shard_rows(self, shard, model):
+        with sharding.engine(shard).connect() as conn:
+            return set(conn.scalars(sa.select(model.__table__.c.id)))
+
+    def test_sharding(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(1, 5)]
+        db.session.add_all(users)
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=users[i % 4], timestamp=now + timedelta(seconds=i))
+                 for i in range(8)]
+        db.session.add_all(posts)
+        users[0].follow(users[1])
+        db.session.commit()
+
+        # Every post is on the shard of its author, with ids unique across shards.
+        authors = {p.id: p.user_id for p in posts}
+        self.assertEqual(len(authors), 8)
+        for shard in sharding.shards():
+            self.assertEqual(self.shard_rows(shard, Post),
+                             {id for id, user_id in authors.items()
+                              if sharding.shard_for(user_id) == shard})
+
+        def explore(page):
+            return [p.body for p in archive.paginate(
+                lambda model: sa.select(model).order_by(model.timestamp.desc(), model.id.desc()),
+                page, 3).items]
+        newest_first = [f'post {i}' for i in reversed(range(8))]
+        self.assertEqual(explore(1) + explore(2) + explore(3), newest_first)
+        query_for, shards = users[0].timeline()
+        self.assertEqual([p.body for p in archive.paginate(query_for, 1, 10, shards).items],
+                         ['post 5', 'post 4', 'post 1', 'post 0'])
+
+        msg = Message(author=users[2], recipient=users[1], body='hi')
+        db.session.add(msg)
+        Conversation.record(msg)
+        db.session.commit()
+        self.assertEqual(self.shard_rows(sharding.shard_for(users[1].id), Message), {msg.id})
+        [(participant, other, last)] = Participant.inbox(users[1])
+        self.assertEqual((other, last.body), (users[2], 'hi'))
+        self.assertEqual(users[1].unread_message_count(), 1)
+
+        # A fourth shard: rebalancing moves the rows that now belong there.
+        self.app.config['SHARDS'] = ['shard0', 'shard1', 'shard2', 'shard3']
+        db.session.remove()
+        moved = sharding.rebalance(chunk_size=2)
+        self.assertEqual(moved['post'], 4)  # the posts of users 3 and 4
+        for shard in sharding.shards():
+            self.assertEqual(self.shard_rows(shard, Post),
+                             {id for id, user_id in authors.items()
+                              if sharding.shard_for(user_id) == shard})
+        self.assertEqual(explore(1) + explore(2) + explore(3), newest_first)
+        self.assertEqual([m.body for m in db.session.scalar(sa.select(Conversation)).messages()],
+                         ['hi'])
+
+
+class LogQueueCase(unittest.TestCase):
+    def error(self, message, line=10):
+        record = logging.LogRecord('app', logging.ERROR, 'routes.py', line, message, None, None)
+        record.exc_text = f'Traceback (most recent call last):\n  File "x.py", line {line}\nKeyError: 1'
+        return record
+
+    def test_error_mail_throttling(self):
+        handler = logqueue.ErrorMailHandler('localhost', 'from@example.com', ['to@example.com'],
+                                            'failure', dedup_window=600, max_per_hour=2)
+        now = [0.0]
+        sent = []
+        with mock.patch.object(logqueue.time, 'monotonic', lambda: now[0]), \
+                mock.patch.object(logging.handlers.SMTPHandler, 'emit',
+                                  lambda self, record: sent.append(record.msg)):
+            handler.emit(self.error('first'))
+            handler.emit(self.error('again'))  # same error within the window
+            handler.emit(self.error('again'))
+            handler.emit(self.error('other', line=20))
+            handler.emit(self.error('third', line=30))  # over the hourly budget
+            self.assertEqual(sent, ['first', 'other'])
+            now[0] = 3601.0
+            handler.emit(self.error('later'))
+        self.assertEqual(sent[2], 'later\n\n2 more of this error since the last mail\n'
+                                  '1 other errors were not mailed (hourly limit)')
+
+    def test_dropped_records_notice(self):
+        log_queue = queue.Queue(maxsize=2)
+        handler = logqueue.RequestQueueHandler(log_queue)
+        for i in range(3):
+            handler.emit(logging.LogRecord('app', logging.INFO, 'x.py', 1, 'r%d', (i,), None))
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual([log_queue.get_nowait().msg for _ in range(2)], ['r0', 'r1'])
+        handler.emit(logging.LogRecord('app', logging.INFO, 'x.py', 1, 'r3', None, None))
+        self.assertEqual(log_queue.get_nowait().msg, 'r3')
+        self.assertEqual(log_queue.get_nowait().getMessage(),
+                         '1 log records dropped: the log queue was full')
+        self.assertEqual(handler.dropped, 0)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)